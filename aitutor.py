@@ -1,17 +1,8 @@
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts.chat import ChatPromptTemplate,SystemMessagePromptTemplate,HumanMessagePromptTemplate,AIMessagePromptTemplate
-from langchain.chains import SequentialChain, LLMChain
-import datetime
+from functools import lru_cache
 
-from dotenv import load_dotenv
-import os
-
-load_dotenv()  # This loads the environment variables from the .env file
-
-# Now you can access your API key
-api_key = os.getenv('OPENAI_API_KEY')
-
-start = datetime.datetime.now()
+from llm_cache import as_langchain_cache, get_default_cache
+from llm_clients import backend_config, get_llm
+from rate_limiter import with_retries
 
 # Set Input Variables
 model="gpt-4"
@@ -30,9 +21,6 @@ topic="p-values"
 primary_language="English"
 course_expertise="Novice"
 
-# Link to OpenAI LLM
-llm = ChatOpenAI(model=model,temperature=temperature, openai_api_key=api_key)
-
 ######################
 """BUILD THE CHAIN"""
 ######################
@@ -47,8 +35,6 @@ The student needs to hear your response to match their {course_expertise} level
 
 Make your responses relevant to {background}.
 '''
-system_message_prompt=SystemMessagePromptTemplate.from_template(system_template)
-
 
 
 intro_template = '''
@@ -56,13 +42,6 @@ Please briefly define and overview the topic of {topic} in {course} relevant to
 
 ONLY return a top level introduction to this topic.  Limit the output to less than 100 words.
 '''
-intro_message_prompt = HumanMessagePromptTemplate.from_template(intro_template)
-
-intro_prompt = ChatPromptTemplate.from_messages([system_message_prompt,intro_message_prompt])
-
-chain_intro = LLMChain(llm=llm,
-                     prompt=intro_prompt,
-                     output_key="intro_response")
 
 
 keyconcepts_template = '''
@@ -81,11 +60,6 @@ Provide your output response in JSON format to make it easy to parse.  The JSON
 
 Limit the output to less than 300 words.
 '''
-keyconcepts_prompt = ChatPromptTemplate.from_template(keyconcepts_template)
-
-chain_keyconcepts = LLMChain(llm=llm,
-                     prompt=keyconcepts_prompt,
-                     output_key="keyconcepts_response")
 
 
 application_template = '''
@@ -94,11 +68,6 @@ Please provide a description of a relevant example that demonstrate and clarifie
 
 Your output response should address each of the key concepts listed in the last step and how it is applied with this example.
 '''
-application_prompt = ChatPromptTemplate.from_template(application_template)
-
-chain_application = LLMChain(llm=llm,
-                     prompt=application_prompt,
-                     output_key="application_response")
 
 
 example_template = '''
@@ -107,11 +76,6 @@ Please generate a sample dataset of the example you provided.  Provide this in a
 
 The format of the data should be one that can be copied and pasted into a spreadsheet like Excel.  Save this table and make it available as a CSV file for the user.
 '''
-example_prompt = ChatPromptTemplate.from_template(example_template)
-
-chain_example = LLMChain(llm=llm,
-                     prompt=example_prompt,
-                     output_key="example_response")
 
 
 analyze_template = '''
@@ -123,11 +87,6 @@ Provide the numeric results as appropriate for each step and what the value mean
 
 Summarize the assumptions, context, limitations and interpretations to clarify the results of this analysis.
 '''
-analyze_prompt = ChatPromptTemplate.from_template(analyze_template)
-
-chain_analyze = LLMChain(llm=llm,
-                     prompt=analyze_prompt,
-                     output_key="analyze_response")
 
 
 visualize_template = '''
@@ -138,16 +97,63 @@ Provide an explanation for each visual and its relevance to understanding the {t
 
 Provide both the visual images as PNG files and as python code needed to create them for this example. 
 '''
-visualize_prompt = ChatPromptTemplate.from_template(visualize_template)
 
-chain_visualize = LLMChain(llm=llm,
-                     prompt=visualize_prompt,
-                     output_key="visualize_response")
 
+def build_chains():
+    """
+    Builds the LLM, prompts and sequential chains on first use and returns the four sequential chains
+    (intro and key concepts, application and example, analysis, visualization), reused on every later call
+    with the same model backend (see llm_clients.backend_config).
+    """
+    return _build_chains(backend_config())
 
 
-def process_chains(topic, background, name, course, course_expertise):
-    # Chain 1: Intro and Key Concepts
+@lru_cache(maxsize=None)
+def _build_chains(config):
+    from langchain.chains import SequentialChain, LLMChain
+    from langchain.globals import set_llm_cache
+    from langchain.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
+
+    # Link to OpenAI LLM
+    llm = get_llm(model, temperature)
+
+    # Serve repeated prompts from the shared in-memory/SQLite response cache
+    cache = get_default_cache()
+    set_llm_cache(as_langchain_cache(cache) if cache is not None else None)
+
+    system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
+
+    intro_message_prompt = HumanMessagePromptTemplate.from_template(intro_template)
+    intro_prompt = ChatPromptTemplate.from_messages([system_message_prompt,intro_message_prompt])
+    chain_intro = LLMChain(llm=llm,
+                         prompt=intro_prompt,
+                         output_key="intro_response")
+
+    keyconcepts_prompt = ChatPromptTemplate.from_template(keyconcepts_template)
+    chain_keyconcepts = LLMChain(llm=llm,
+                         prompt=keyconcepts_prompt,
+                         output_key="keyconcepts_response")
+
+    application_prompt = ChatPromptTemplate.from_template(application_template)
+    chain_application = LLMChain(llm=llm,
+                         prompt=application_prompt,
+                         output_key="application_response")
+
+    example_prompt = ChatPromptTemplate.from_template(example_template)
+    chain_example = LLMChain(llm=llm,
+                         prompt=example_prompt,
+                         output_key="example_response")
+
+    analyze_prompt = ChatPromptTemplate.from_template(analyze_template)
+    chain_analyze = LLMChain(llm=llm,
+                         prompt=analyze_prompt,
+                         output_key="analyze_response")
+
+    visualize_prompt = ChatPromptTemplate.from_template(visualize_template)
+    chain_visualize = LLMChain(llm=llm,
+                         prompt=visualize_prompt,
+                         output_key="visualize_response")
+
     intro_and_keyconcepts_chain = SequentialChain(
         chains=[
             chain_intro,
@@ -167,18 +173,6 @@ def process_chains(topic, background, name, course, course_expertise):
         verbose=True
     )
 
-    intro_and_keyconcepts_results = intro_and_keyconcepts_chain(inputs={
-        'topic': topic,
-        'background': background, 
-        'name': name,
-        'course': course,
-        'course_expertise': course_expertise
-    })
-    yield intro_and_keyconcepts_results['intro_response']
-    yield intro_and_keyconcepts_results['keyconcepts_response']
-
-
-    # Chain 2: Application and Example
     application_and_example_chain = SequentialChain(
         chains=[
             chain_application,
@@ -200,23 +194,6 @@ def process_chains(topic, background, name, course, course_expertise):
         verbose=True
     )
 
-    application_and_example_results = application_and_example_chain(inputs={
-        'topic': topic,
-        'background': background, 
-        'name': name,
-        'course': course,
-        'course_expertise': course_expertise,
-        'intro_response': intro_and_keyconcepts_results['intro_response'],
-        'keyconcepts_response': intro_and_keyconcepts_results['keyconcepts_response']
-    })
-    yield application_and_example_results['application_response']
-    yield application_and_example_results['example_response']
-
-# quality, cost, maintainability
-# Try Streaming and batching
-# trade off: gpt-4 vs gpt 4 turbo
-
-    # Chain 3: Analyze
     analysis_chain = SequentialChain(
         chains=[
             chain_analyze
@@ -238,21 +215,6 @@ def process_chains(topic, background, name, course, course_expertise):
         verbose=True
     )
 
-    analysis_results = analysis_chain(inputs={
-        'topic': topic,
-        'background': background, 
-        'name': name,
-        'course': course,
-        'course_expertise': course_expertise,
-        'intro_response': intro_and_keyconcepts_results['intro_response'],
-        'keyconcepts_response': intro_and_keyconcepts_results['keyconcepts_response'],
-        'application_response': application_and_example_results['application_response'],
-        'example_response': application_and_example_results['example_response']
-    })
-    yield analysis_results['analyze_response']
-
-
-    # Chain 4: Visualize
     visualization_chain = SequentialChain(
         chains=[
             chain_visualize
@@ -275,7 +237,68 @@ def process_chains(topic, background, name, course, course_expertise):
         verbose=True
     )
 
-    visualization_results = visualization_chain(inputs={
+    return intro_and_keyconcepts_chain, application_and_example_chain, analysis_chain, visualization_chain
+
+
+def run_chain(chain, inputs, callbacks=None):
+    """Runs one sequential chain, retrying transient provider errors (see rate_limiter.with_retries)."""
+    return with_retries(lambda: chain(inputs=inputs, callbacks=callbacks))
+
+
+def process_chains(topic, background, name, course, course_expertise, callbacks=None):
+    """
+    Runs the four sequential chains and yields the six stage responses in order.
+
+    `callbacks` are langchain callback handlers passed to every chain call, e.g. the stage timer in benchmark.py.
+    """
+    intro_and_keyconcepts_chain, application_and_example_chain, analysis_chain, visualization_chain = build_chains()
+
+    # Chain 1: Intro and Key Concepts
+    intro_and_keyconcepts_results = run_chain(intro_and_keyconcepts_chain, callbacks=callbacks, inputs={
+        'topic': topic,
+        'background': background, 
+        'name': name,
+        'course': course,
+        'course_expertise': course_expertise
+    })
+    yield intro_and_keyconcepts_results['intro_response']
+    yield intro_and_keyconcepts_results['keyconcepts_response']
+
+
+    # Chain 2: Application and Example
+    application_and_example_results = run_chain(application_and_example_chain, callbacks=callbacks, inputs={
+        'topic': topic,
+        'background': background, 
+        'name': name,
+        'course': course,
+        'course_expertise': course_expertise,
+        'intro_response': intro_and_keyconcepts_results['intro_response'],
+        'keyconcepts_response': intro_and_keyconcepts_results['keyconcepts_response']
+    })
+    yield application_and_example_results['application_response']
+    yield application_and_example_results['example_response']
+
+# quality, cost, maintainability
+# Try Streaming and batching
+# trade off: gpt-4 vs gpt 4 turbo
+
+    # Chain 3: Analyze
+    analysis_results = run_chain(analysis_chain, callbacks=callbacks, inputs={
+        'topic': topic,
+        'background': background, 
+        'name': name,
+        'course': course,
+        'course_expertise': course_expertise,
+        'intro_response': intro_and_keyconcepts_results['intro_response'],
+        'keyconcepts_response': intro_and_keyconcepts_results['keyconcepts_response'],
+        'application_response': application_and_example_results['application_response'],
+        'example_response': application_and_example_results['example_response']
+    })
+    yield analysis_results['analyze_response']
+
+
+    # Chain 4: Visualize
+    visualization_results = run_chain(visualization_chain, callbacks=callbacks, inputs={
         'topic': topic,
         'background': background, 
         'name': name,
@@ -297,8 +320,6 @@ if __name__ =="__main__":
         # Here, instead of printing, you can send this response to your front end
 
 
-
-
 """
 # Break down the sequntial chain
 seq_chain_1 = SequentialChain(
@@ -1,7 +1,33 @@
+import time
+import uuid
+
 import streamlit as st
-from explain_the_concepts_new import process_chains  
+from explain_the_concepts_new import STAGE_TITLES, SessionRequest, build_chains, chains_key
+import metrics
+from llm_clients import warm_up
+from prefetch import Prefetcher
+from session_jobs import SessionJobs
+
+# Seconds between two refreshes of a running session's sections
+POLL_INTERVAL = 0.1
+
+# Open the pooled API connection ahead of the first session (opt-in with AITUTOR_WARM_UP=1)
+warm_up()
+# Serve per-stage metrics at /metrics when AITUTOR_METRICS_PORT is set
+metrics.start_from_env()
+
+
+@st.cache_resource(show_spinner=False)
+def chain_registry(key):
+    """The stages' chains for chains_key() `key`, built once and shared by every session and rerun."""
+    return build_chains(key)
+
+
+@st.cache_resource(show_spinner=False)
+def session_jobs():
+    """The worker pool running the sessions of every student (AITUTOR_SESSION_WORKERS threads)."""
+    return SessionJobs()
 
-# Load environment variables, API key, and initialize your models here
 
 # Streamlit interface
 st.title("AI Tutor for Data Analytics")
@@ -13,6 +39,19 @@ name = st.text_input("Name", "Raj")
 course = st.text_input("Course", "Data Analytics")
 course_expertise = st.selectbox("Course Expertise", ["Novice", "Intermediate", "Advanced"])
 
+request = SessionRequest(
+    topic=topic,
+    background=background,
+    name=name,
+    course=course,
+    course_expertise=course_expertise,
+)
+
+# Start the first section in the background once the inputs have settled (AITUTOR_PREFETCH=0 to disable)
+if "prefetcher" not in st.session_state:
+    st.session_state.prefetcher = Prefetcher()
+st.session_state.prefetcher.update(request)
+
 # # # Button to start processing
 # if st.button("Start Tutoring Session"):
 #     print("Hi")
@@ -20,37 +59,55 @@ course_expertise = st.selectbox("Course Expertise", ["Novice", "Intermediate", "
 #     for response in process_chains(topic, background, name, course, course_expertise):
 #         # Display each response
 #         st.write(response)
+
+# The session runs on the worker pool; the job is kept in the session state, so every rerun (a click, an
+# expanded section, an edited field) renders it again and keeps following it instead of restarting it
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+    st.session_state.job = None
+
 if st.button("Start Tutoring Session"):
-    # Initialize a placeholder for the first section
-    first_section_placeholder = st.empty()
-
-    # Display a loading sign until the first output is returned
-    with first_section_placeholder.container():
-        with st.spinner('Processing the first section...'):
-            responses = process_chains()
-            
-            # Get the first response
-            first_response = next(responses)
-            
-            # Once the first response is ready, display it in the first expanded section
-            with st.expander(f"Section 1: Introduction", expanded=True):
-                st.markdown(first_response)
-
-    # Counter to keep track of the other responses
-    response_counter = 1  # Starts from 1 as we've already processed the first response
-
-
-    for response in responses:
-        response_counter += 1
-
-        # Set the title for each subsection
-        subsection_title = f"Section {response_counter}: " + ("Introduction" if response_counter == 1 else "Key Concepts" if response_counter == 2 else "Application" if response_counter == 3 else "Example" if response_counter == 4 else "Analysis" if response_counter == 5 else "Visualization")
-
-        # Use an expander for each subsection. The first one is expanded by default.
-        with st.expander(subsection_title, expanded=(response_counter == 1)):
-            st.markdown(response)
-
-        # Show a loading sign for the next section until it's loaded
-        if response_counter < 6:  # Assuming there are 6 responses
-            with st.spinner(f'Loading {subsection_title}...'):
-                pass
\ No newline at end of file
+    # Only the sections still missing are generated: a second click on the same inputs costs nothing
+    st.session_state.job = session_jobs().submit(
+        st.session_state.session_id,
+        request,
+        st.session_state.prefetcher.take(request),
+        chain_registry(chains_key()),
+    )
+job = st.session_state.job
+
+if job is not None:
+    if job.previous is not None and len(job.regenerating) < len(STAGE_TITLES):
+        updated = ", ".join(STAGE_TITLES[stage] for stage in job.regenerating) or "nothing"
+        st.caption(f"Only the sections affected by the changed inputs are regenerated: {updated}.")
+
+    # Status line shown until the last section has finished streaming
+    status_placeholder = st.empty()
+
+    # One expander per section, each holding a placeholder that is refreshed as tokens arrive
+    section_placeholders = {}
+    section_texts = {}
+
+    while True:
+        done = job.done  # read first, so the sections rendered last are complete
+        for stage, text in job.snapshot().items():
+            if stage not in section_placeholders:
+                section_number = len(section_placeholders) + 1
+                subsection_title = f"Section {section_number}: {STAGE_TITLES[stage]}"
+                status_placeholder.info(f"Loading {subsection_title}...")
+
+                # The first section is expanded by default
+                with st.expander(subsection_title, expanded=(section_number == 1)):
+                    section_placeholders[stage] = st.empty()
+            if section_texts.get(stage) != text:
+                section_texts[stage] = text
+                section_placeholders[stage].markdown(text)
+        if done:
+            break
+        if not section_placeholders:
+            status_placeholder.info("Waiting for a free tutor...")
+        time.sleep(POLL_INTERVAL)
+
+    status_placeholder.empty()
+    if job.error is not None:
+        st.exception(job.error)
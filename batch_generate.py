@@ -0,0 +1,197 @@
+"""
+Bulk pre-generation of tutoring sessions for a known syllabus.
+
+Reads a CSV or JSONL file of session inputs (topic, background, name, course, course_expertise) and runs
+the explain_the_concepts_new pipeline over all of them, one stage at a time with `Runnable.batch`, so every
+stage of a chunk of rows is sent to the model concurrently (bounded by --max-concurrency). Each
+finished session is written to a JSONL file or SQLite database as soon as its chunk finishes, so an
+interrupted run picks up where it stopped. Stage outputs also land in the response cache, which warms
+it for the class.
+
+Usage:
+    python batch_generate.py syllabus.csv results.jsonl --max-concurrency 8 --chunk-size 32
+"""
+
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+from functools import partial
+from time import time
+
+from explain_the_concepts_new import (
+    STAGE_GRAPH,
+    STAGES,
+    SessionRequest,
+    build_chains,
+    compact_stage_inputs,
+    stage_cache_key,
+    stage_inputs,
+)
+from llm_cache import get_default_cache, make_key
+from rate_limiter import is_retryable, with_retries
+
+INPUT_FIELDS = ("topic", "background", "name", "course", "course_expertise")
+
+
+def read_rows(path):
+    """
+    Reads SessionRequests from a .csv or .jsonl file. `name` defaults to "Student" when missing.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = list(csv.DictReader(f))
+    rows = []
+    for record in records:
+        row = {field: (record.get(field) or "").strip() for field in INPUT_FIELDS}
+        row["name"] = row["name"] or "Student"
+        rows.append(SessionRequest(**row))
+    return rows
+
+
+def row_key(request):
+    return make_key("batch", sorted(request.inputs().items()))
+
+
+class JsonlResults:
+    """Appends one JSON record per finished session."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def done_keys(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return set()
+        return {record["key"] for record in records if "error" not in record}
+
+    def write(self, records):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+
+class SqliteResults:
+    """Keeps one row per session, replacing earlier failed attempts."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, failed INTEGER, record TEXT)")
+
+    def done_keys(self):
+        return {key for (key,) in self.db.execute("SELECT key FROM results WHERE failed = 0")}
+
+    def write(self, records):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO results (key, failed, record) VALUES (?, ?, ?)",
+            [(record["key"], int("error" in record), json.dumps(record)) for record in records],
+        )
+        self.db.commit()
+
+
+def open_results(path):
+    if path.endswith((".sqlite", ".db")):
+        return SqliteResults(path)
+    return JsonlResults(path)
+
+
+def run_chunk(chains, rows, max_concurrency):
+    """
+    Runs the whole pipeline over `rows`, one stage at a time, and returns one record per row.
+
+    Rows whose stage output is cached skip the model for that stage; the remaining rows go to the stage's
+    primary model's chain as a single `batch` call. A row that fails a stage with a transient provider error
+    is retried on its own with backoff, then handed to the stage's fallback model (see model_routes.py); a
+    row that still fails is reported with its error and dropped from the later stages.
+    """
+    cache = get_default_cache()
+    states = [request.inputs() for request in rows]
+    errors = [None] * len(rows)
+    for stage in STAGES:
+        pending = []
+        for index, state in enumerate(states):
+            if errors[index] is not None:
+                continue
+            inputs = compact_stage_inputs(stage, stage_inputs(stage, state))
+            # one call per row, never fanned out (see explain_the_concepts_new.fan_out_inputs)
+            key = stage_cache_key(stage, inputs, state, fans_out=False) if cache is not None else None
+            cached = cache.get(key) if cache is not None else None
+            if cached is not None:
+                state[STAGE_GRAPH[stage].produces] = cached
+            else:
+                pending.append((index, inputs, key))
+
+        if pending:
+            routed = chains[stage]
+            outputs = routed.primary.batch(
+                [inputs for _, inputs, _ in pending],
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=True,
+            )
+            for (index, inputs, key), output in zip(pending, outputs):
+                if isinstance(output, Exception) and is_retryable(output):
+                    try:
+                        output = with_retries(partial(routed.primary.invoke, inputs))
+                    except Exception as error:
+                        output = error
+                fallback = isinstance(output, Exception) and routed.route.fallback is not None
+                if fallback:
+                    try:
+                        output = with_retries(partial(routed.chains[routed.route.fallback].invoke, inputs))
+                    except Exception as error:
+                        output = error
+                if isinstance(output, Exception):
+                    errors[index] = f"{stage}: {output!r}"
+                    continue
+                states[index][STAGE_GRAPH[stage].produces] = output
+                if cache is not None and not fallback:
+                    cache.put(key, output)
+
+    records = []
+    for row, state, error in zip(rows, states, errors):
+        record = {"key": row_key(row), "inputs": row.inputs()}
+        if error is not None:
+            record["error"] = error
+        else:
+            record["responses"] = {stage: state[STAGE_GRAPH[stage].produces] for stage in STAGES}
+        records.append(record)
+    return records
+
+
+def generate(input_path, output_path, max_concurrency=4, chunk_size=16):
+    """Pre-generates every session in `input_path` that is not already in `output_path`."""
+    results = open_results(output_path)
+    done = results.done_keys()
+    rows = [row for row in read_rows(input_path) if row_key(row) not in done]
+    print(f"{len(done)} sessions already generated, {len(rows)} to go", file=sys.stderr)
+
+    chains = build_chains()
+    start_time = time()
+    failed = 0
+    for start in range(0, len(rows), chunk_size):
+        records = run_chunk(chains, rows[start : start + chunk_size], max_concurrency)
+        results.write(records)
+        failed += sum("error" in record for record in records)
+        finished = start + len(records)
+        elapsed = time() - start_time
+        print(
+            f"[{finished}/{len(rows)}] {elapsed:.1f} s elapsed, {failed} failed, "
+            f"{finished / elapsed:.2f} sessions/s",
+            file=sys.stderr,
+        )
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate tutoring sessions for a syllabus.")
+    parser.add_argument("input", help="CSV or JSONL file with topic, background, name, course, course_expertise")
+    parser.add_argument("output", help="results file: .jsonl, or .sqlite/.db for a SQLite database")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="model calls in flight per stage")
+    parser.add_argument("--chunk-size", type=int, default=16, help="sessions per batch and per progress report")
+    args = parser.parse_args()
+    sys.exit(1 if generate(args.input, args.output, args.max_concurrency, args.chunk_size) else 0)
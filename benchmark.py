@@ -0,0 +1,262 @@
+"""
+Pipeline benchmark: single-session latency, per-stage overhead, multi-session throughput and peak memory
+of each tutoring pipeline implementation, against the offline model in fake_llm.py.
+
+Implementations:
+- aitutor: the SequentialChain pipeline in aitutor.py;
+- lcel: process_chains() in explain_the_concepts_new.py;
+- lcel-graph: process_stage_graph() in explain_the_concepts_new.py, stages run as soon as their inputs are ready.
+
+Each implementation runs in a fresh interpreter (so peak RSS and warm caches are its own) and is measured on:
+- latency: p50/p95 wall time of one session at a time, with the fake model's latency profile;
+- overhead: wall time of each stage against a zero-latency fake model, i.e. everything but model time
+  (prompt rendering, chain machinery, budgets, metrics);
+- throughput: sessions/sec with N sessions running concurrently on threads;
+- peak RSS of the process.
+The response cache, single-flight coalescing, hedging and tracing are turned off so every session does the
+full work and no more: a hedge is a duplicate call the aitutor pipeline would not make either.
+
+Usage:
+    python benchmark.py                                 # print the report
+    python benchmark.py -o BENCHMARK.json               # also save the results
+    python benchmark.py --baseline BENCHMARK.json       # exit 1 if anything regressed by more than 20%
+    python benchmark.py lcel --concurrency 1 16 64 --first-token-delay 0.5
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+IMPLEMENTATIONS = ["aitutor", "lcel", "lcel-graph"]
+
+# Results where a larger value is better; for every other result smaller is better
+HIGHER_IS_BETTER = ("sessions_per_s",)
+
+
+def _fake_backend(first_token_delay, tokens_per_second):
+    os.environ.update(
+        {
+            "AITUTOR_LLM_BACKEND": "fake",
+            "AITUTOR_FAKE_FIRST_TOKEN_DELAY": str(first_token_delay),
+            "AITUTOR_FAKE_TOKENS_PER_SECOND": str(tokens_per_second),
+        }
+    )
+
+
+def _session_runner(implementation):
+    """Returns callable(callbacks) running one session of `implementation` to completion."""
+    if implementation == "aitutor":
+        import aitutor
+        from explain_the_concepts_new import DEFAULT_REQUEST as request
+
+        return lambda callbacks=None: list(aitutor.process_chains(**request.inputs(), callbacks=callbacks))
+
+    from explain_the_concepts_new import DEFAULT_REQUEST, process_chains, process_stage_graph
+
+    if implementation == "lcel":
+        return lambda callbacks=None: list(process_chains(DEFAULT_REQUEST))
+    if implementation == "lcel-graph":
+        return lambda callbacks=None: list(process_stage_graph(DEFAULT_REQUEST))
+    raise ValueError(f"Unknown implementation {implementation!r}, expected one of {IMPLEMENTATIONS}")
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def _stage_overhead(implementation, run, sessions):
+    """Returns {stage: mean seconds} over `sessions` sessions against a zero-latency model."""
+    if implementation == "aitutor":
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        class StageTimer(BaseCallbackHandler):
+            """Times every LLMChain, i.e. every chain run with a parent, by the output key it produces."""
+
+            def __init__(self):
+                self.starts = {}
+                self.totals = {}
+
+            def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+                if parent_run_id is not None:
+                    self.starts[run_id] = time.perf_counter()
+
+            def on_chain_end(self, outputs, *, run_id, **kwargs):
+                start = self.starts.pop(run_id, None)
+                if start is not None and len(outputs) == 1:
+                    stage = next(iter(outputs)).removesuffix("_response")
+                    self.totals[stage] = self.totals.get(stage, 0.0) + time.perf_counter() - start
+
+        timer = StageTimer()
+        for _ in range(sessions):
+            run([timer])
+        return {stage: total / sessions for stage, total in timer.totals.items()}
+
+    from metrics import registry
+
+    registry.histograms.clear()
+    for _ in range(sessions):
+        run()
+    totals = {}
+    for (name, labels), histogram in registry.histograms.items():
+        if name == "aitutor_stage_seconds":
+            stage = dict(labels)["stage"]
+            totals[stage] = totals.get(stage, 0.0) + histogram.sum
+    return {stage: total / sessions for stage, total in totals.items()}
+
+
+def measure(implementation, sessions, concurrency, first_token_delay, tokens_per_second):
+    """Runs every measurement for `implementation` in this process and returns the results as a dict."""
+    os.environ.update(
+        {"AITUTOR_CACHE": "0", "AITUTOR_SINGLE_FLIGHT": "0", "AITUTOR_HEDGE_BUDGET": "0", "AITUTOR_TRACE_SAMPLE_RATE": "0"}
+    )
+    run = _session_runner(implementation)
+
+    _fake_backend(0, 0)
+    run()  # builds the chains, so one-off setup is not measured
+    overhead = _stage_overhead(implementation, run, sessions)
+    session_overhead = []
+    for _ in range(sessions):
+        start = time.perf_counter()
+        run()
+        session_overhead.append(time.perf_counter() - start)
+
+    _fake_backend(first_token_delay, tokens_per_second)
+    latencies = []
+    for _ in range(sessions):
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+
+    throughput = {}
+    for users in concurrency:
+        count = users * 2
+        with ThreadPoolExecutor(max_workers=users) as executor:
+            start = time.perf_counter()
+            list(executor.map(lambda _: run(), range(count)))
+            throughput[str(users)] = count / (time.perf_counter() - start)
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "implementation": implementation,
+        "latency_p50_s": _percentile(latencies, 0.5),
+        "latency_p95_s": _percentile(latencies, 0.95),
+        "overhead_per_session_s": _percentile(session_overhead, 0.5),
+        "overhead_per_stage_s": overhead,
+        "sessions_per_s": throughput,
+        "peak_rss_mb": max_rss / 1024 if sys.platform != "darwin" else max_rss / 1024 / 1024,
+    }
+
+
+def run_isolated(implementation, args):
+    """Runs measure() for `implementation` in a fresh interpreter and returns its results."""
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--worker",
+        implementation,
+        "--sessions",
+        str(args.sessions),
+        "--first-token-delay",
+        str(args.first_token_delay),
+        "--tokens-per-second",
+        str(args.tokens_per_second),
+        "--concurrency",
+        *map(str, args.concurrency),
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"{implementation} benchmark failed:\n{result.stderr.strip()}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def report(results, args):
+    lines = [
+        "# Pipeline benchmark",
+        "",
+        f"Fake model: {args.first_token_delay}s to first token, {args.tokens_per_second or 'unlimited'} tokens/s; "
+        f"{args.sessions} sessions per measurement.",
+        "",
+        "| implementation | p50 (s) | p95 (s) | overhead/session (ms) | "
+        + " | ".join(f"sessions/s @{users}" for users in args.concurrency)
+        + " | peak RSS (MB) |",
+        "|---|---:|---:|---:|" + "---:|" * len(args.concurrency) + "---:|",
+    ]
+    for result in results:
+        throughput = " | ".join(f"{result['sessions_per_s'][str(users)]:.2f}" for users in args.concurrency)
+        lines.append(
+            f"| {result['implementation']} | {result['latency_p50_s']:.2f} | {result['latency_p95_s']:.2f} "
+            f"| {result['overhead_per_session_s'] * 1000:.1f} | {throughput} | {result['peak_rss_mb']:.0f} |"
+        )
+    lines += ["", "Per-stage overhead (ms, zero-latency model):", ""]
+    stages = list(dict.fromkeys(stage for result in results for stage in result["overhead_per_stage_s"]))
+    lines.append("| implementation | " + " | ".join(stages) + " |")
+    lines.append("|---|" + "---:|" * len(stages))
+    for result in results:
+        values = [result["overhead_per_stage_s"].get(stage) for stage in stages]
+        cells = " | ".join("-" if value is None else f"{value * 1000:.1f}" for value in values)
+        lines.append(f"| {result['implementation']} | {cells} |")
+    return "\n".join(lines)
+
+
+def regressions(results, baseline, tolerance):
+    """Returns a description of every result that is more than `tolerance` worse than in `baseline`."""
+    previous = {result["implementation"]: result for result in baseline}
+    found = []
+    for result in results:
+        old = previous.get(result["implementation"])
+        if old is None:
+            continue
+        pairs = [(key, result[key], old[key]) for key in ("latency_p50_s", "latency_p95_s", "overhead_per_session_s", "peak_rss_mb")]
+        pairs += [
+            (f"sessions_per_s@{users}", value, old["sessions_per_s"][users])
+            for users, value in result["sessions_per_s"].items()
+            if users in old["sessions_per_s"]
+        ]
+        for key, new_value, old_value in pairs:
+            if key.startswith(HIGHER_IS_BETTER):
+                worse = new_value < old_value * (1 - tolerance)
+            else:
+                worse = new_value > old_value * (1 + tolerance)
+            if worse:
+                found.append(f"{result['implementation']} {key}: {old_value:.4g} -> {new_value:.4g}")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tutoring pipelines against the offline fake model.")
+    parser.add_argument("implementations", nargs="*", default=IMPLEMENTATIONS, help=f"any of {IMPLEMENTATIONS}")
+    parser.add_argument("--sessions", type=int, default=5, help="sessions per latency/overhead measurement")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="concurrent sessions")
+    parser.add_argument("--first-token-delay", type=float, default=0.1, help="fake model seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=1000, help="fake model streaming rate")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with contextlib.redirect_stdout(io.StringIO()):  # the SequentialChains in aitutor.py are verbose
+            results = measure(args.worker, args.sessions, args.concurrency, args.first_token_delay, args.tokens_per_second)
+        print(json.dumps(results))
+        sys.exit(0)
+
+    results = [run_isolated(implementation, args) for implementation in args.implementations]
+    print(report(results, args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        if found:
+            print("\nRegressions:\n" + "\n".join(found))
+            sys.exit(1)
@@ -0,0 +1,191 @@
+"""
+Record-and-replay cassettes of real model calls, for latency-faithful load tests.
+
+Recording: with AITUTOR_RECORD_CASSETTE=<path>, every model call made by the explain_the_concepts_new stages
+is captured by CassetteRecorder (a langchain callback handler): stage, model, prompt, response chunks and
+the time each chunk arrived. Calls are appended to a gzip-compressed JSONL file, one call per line:
+
+    {"stage": "intro", "model": "gpt-3.5-turbo", "prompt": "...", "offsets_ms": [812, 830, ...],
+     "chunks": ["P-values", " are", ...]}
+
+Replay: AITUTOR_LLM_BACKEND=replay with AITUTOR_CASSETTE=<path> swaps every stage's model for ReplayChatModel,
+which answers each prompt with its recorded chunks at the recorded times (scaled by AITUTOR_REPLAY_SPEED,
+e.g. 2 to play twice as fast). Because upstream outputs are replayed verbatim, downstream prompts match
+the recording exactly and the session goes through the same process_chains() code path as in production.
+
+Run with AITUTOR_CACHE=0 while recording and replaying, so every stage actually reaches the model.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+def prompt_text(messages):
+    """Flattens a list of chat messages into the text cassettes are keyed by."""
+    return "\n".join(str(message.content) for message in messages)
+
+
+def prompt_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def read_cassette(path):
+    """Returns the calls recorded in the cassette at `path`."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class CassetteRecorder(BaseCallbackHandler):
+    """Callback handler appending every chat model call it sees to the cassette at `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        params = kwargs.get("invocation_params") or {}
+        stage = next((tag.split(":", 1)[1] for tag in tags or [] if tag.startswith("stage:")), None)
+        self._runs[run_id] = {
+            "stage": stage,
+            "model": params.get("model") or params.get("model_name"),
+            "prompt": prompt_text(messages[0]),
+            "start": time.perf_counter(),
+            "offsets_ms": [],
+            "chunks": [],
+        }
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None:
+            run["offsets_ms"].append(round((time.perf_counter() - run["start"]) * 1000))
+            run["chunks"].append(token)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        if not run["chunks"]:  # non-streaming call: one chunk when the whole response arrived
+            run["offsets_ms"].append(round((time.perf_counter() - run["start"]) * 1000))
+            run["chunks"].append(response.generations[0][0].text)
+        del run["start"]
+        line = json.dumps(run) + "\n"
+        with self._lock, gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write(line)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._runs.pop(run_id, None)
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_recorder():
+    """Returns the recorder for AITUTOR_RECORD_CASSETTE, or None when recording is off."""
+    path = os.getenv("AITUTOR_RECORD_CASSETTE")
+    if not path:
+        return None
+    with _recorders_lock:
+        if path not in _recorders:
+            _recorders[path] = CassetteRecorder(path)
+        return _recorders[path]
+
+
+class ReplayChatModel(BaseChatModel):
+    """
+    Chat model answering from a cassette with the recorded timing.
+
+    A prompt that is not in the cassette (e.g. after a prompt template change) gets one of the recorded
+    calls for the same model, picked deterministically from the prompt, so load tests keep running with a
+    realistic latency profile; `misses` counts how often that happened.
+    """
+
+    model_name: str = "replay"
+    speed: float = 1.0
+    by_prompt: Dict[str, List[Any]] = {}
+    by_model: Dict[str, List[Any]] = {}
+    misses: int = 0
+
+    @classmethod
+    def from_cassette(cls, path, model_name="replay", speed=1.0):
+        by_prompt = defaultdict(list)
+        by_model = defaultdict(list)
+        for call in read_cassette(path):
+            by_prompt[prompt_hash(call["prompt"])].append(call)
+            by_model[call["model"]].append(call)
+        return cls(model_name=model_name, speed=speed, by_prompt=dict(by_prompt), by_model=dict(by_model))
+
+    @property
+    def _llm_type(self):
+        return "cassette-replay"
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": self.model_name, "speed": self.speed}
+
+    def _call(self, messages):
+        text = prompt_text(messages)
+        checksum = zlib.crc32(text.encode("utf-8"))
+        calls = self.by_prompt.get(prompt_hash(text))
+        if not calls:
+            self.misses += 1
+            calls = self.by_model.get(self.model_name) or [call for calls in self.by_model.values() for call in calls]
+            if not calls:
+                raise ValueError("The cassette has no recorded calls")
+        return calls[checksum % len(calls)]
+
+    def _schedule(self, messages):
+        """Yields (seconds to wait, chunk) for each recorded chunk."""
+        call = self._call(messages)
+        previous = 0
+        for offset, chunk in zip(call["offsets_ms"], call["chunks"]):
+            yield (offset - previous) / 1000 / self.speed, chunk
+            previous = offset
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for delay, token in self._schedule(messages):
+            if delay > 0:
+                time.sleep(delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for delay, token in self._schedule(messages):
+            if delay > 0:
+                await asyncio.sleep(delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        chunks = [chunk.message.content async for chunk in self._astream(messages, stop, run_manager, **kwargs)]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(chunks)))])
+
+
+def replay_llm_from_env(model):
+    """Returns a ReplayChatModel standing in for `model`, from AITUTOR_CASSETTE and AITUTOR_REPLAY_SPEED."""
+    path = os.getenv("AITUTOR_CASSETTE")
+    if not path:
+        raise ValueError("AITUTOR_LLM_BACKEND=replay needs AITUTOR_CASSETTE=<path to a recorded cassette>")
+    return ReplayChatModel.from_cassette(path, model_name=model, speed=float(os.getenv("AITUTOR_REPLAY_SPEED", "1")))
@@ -0,0 +1,183 @@
+"""
+Caps the size of upstream outputs before they are inlined into a downstream prompt.
+
+fit_to_budget() brings the given variables of a stage's inputs under a token budget in three steps, stopping
+as soon as they fit:
+1. structural compaction per variable, e.g. compact_key_concepts() to keep only the key-concept list or
+   truncate_tables() to keep a table's header plus a few rows;
+2. an optional caller-supplied summarizer (a cheap model call);
+3. truncation of every variable to its share of the budget, at a paragraph or sentence boundary where
+   possible. Shares are split evenly, and whatever a small variable does not need goes to the larger ones.
+"""
+
+import json
+import re
+
+from token_count import count_tokens
+
+TRUNCATION_MARK = " [...]"
+
+
+def parse_key_concepts(text):
+    """
+    Extracts the key concepts from the keyconcepts stage's output, which the prompt asks to be JSON of the
+    form `"1": "Concept 1 ...", "2": "Concept 2 ..."`, possibly wrapped in prose, braces or #### fences.
+    A concept given as an object, e.g. `"1": {"name": "...", "description": "..."}`, is the text of its
+    string fields joined. Falls back to a plain numbered list. Returns the concepts in order, or [] if none
+    could be found.
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            parsed = json.loads(text[start : end + 1])
+        except ValueError:
+            parsed = None
+        if isinstance(parsed, dict) and parsed:
+            concepts = [_concept_text(value) for _, value in sorted(parsed.items(), key=lambda item: _number(item[0]))]
+            if all(concepts):
+                return concepts
+
+    pairs = re.findall(r'"(\d+)"\s*:\s*"((?:[^"\\]|\\.)*)"', text, re.DOTALL)
+    if pairs:
+        return [value.strip() for _, value in sorted(pairs, key=lambda pair: int(pair[0]))]
+
+    return [item.strip() for item in re.findall(r"^\s*\d+[.)]\s+(.+)$", text, re.MULTILINE)]
+
+
+def _concept_text(value):
+    """Returns the text of one parsed concept: a string, or the string fields of an object; "" otherwise."""
+    if isinstance(value, dict):
+        return ": ".join(field.strip() for field in value.values() if isinstance(field, str) and field.strip())
+    return value.strip() if isinstance(value, str) else ""
+
+
+def _number(key):
+    return int(key) if str(key).isdigit() else float("inf")
+
+
+def compact_key_concepts(text, words_per_concept=25):
+    """Reduces a key-concepts response to a numbered list with the start of each concept's description."""
+    concepts = parse_key_concepts(text)
+    if not concepts:
+        return text
+    lines = []
+    for number, concept in enumerate(concepts, 1):
+        words = concept.split()
+        lines.append(f"{number}. {' '.join(words[:words_per_concept])}{' ...' if len(words) > words_per_concept else ''}")
+    return "\n".join(lines)
+
+
+def truncate_tables(text, max_rows=5):
+    """
+    Keeps the header plus `max_rows` data rows of every markdown table and of every CSV block in a ```
+    fence, noting how many rows were dropped. A fence holds CSV when it is tagged `csv`, or untagged with
+    every row having as many commas as its header; other fences (code) are left whole.
+    """
+    lines = text.splitlines()
+    result = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if line.strip().startswith("```"):
+            close = index + 1
+            while close < len(lines) and not lines[close].strip().startswith("```"):
+                close += 1
+            rows = lines[index + 1 : close]
+            result.append(line)
+            if _is_csv_block(line.strip()[3:].strip(), rows):
+                result.extend(_keep_rows(rows, 1 + max_rows, "... {} more rows"))
+            else:
+                result.extend(rows)
+            result.extend(lines[close : close + 1])
+            index = close + 1
+            continue
+
+        block_end = index
+        while block_end < len(lines) and lines[block_end].strip().startswith("|"):
+            block_end += 1
+        if block_end == index:
+            result.append(line)
+            index += 1
+            continue
+        # markdown tables also have a |---| separator
+        result.extend(_keep_rows(lines[index:block_end], 2 + max_rows, "| ... {} more rows |"))
+        index = block_end
+    return "\n".join(result)
+
+
+def _is_csv_block(tag, rows):
+    if tag.lower() == "csv":
+        return True
+    rows = [row for row in rows if row.strip()]
+    if tag or not rows or "," not in rows[0]:
+        return False
+    return all(row.count(",") == rows[0].count(",") for row in rows)
+
+
+def _keep_rows(rows, keep, note):
+    if len(rows) <= keep:
+        return rows
+    return rows[:keep] + [note.format(len(rows) - keep)]
+
+
+def truncate_tokens(text, max_tokens, model="gpt-4"):
+    """Cuts `text` down to about `max_tokens`, preferring to end on a paragraph or sentence boundary."""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    cut = text
+    while cut and count_tokens(cut + TRUNCATION_MARK, model) > max_tokens:
+        target = int(len(cut) * max_tokens / count_tokens(cut + TRUNCATION_MARK, model) * 0.95)
+        cut = cut[: max(target, 0)]
+    for boundary in ("\n\n", ". ", "\n"):
+        position = cut.rfind(boundary)
+        if position > len(cut) // 2:
+            cut = cut[: position + len(boundary.rstrip())]
+            break
+    return cut.rstrip() + TRUNCATION_MARK
+
+
+def fit_to_budget(inputs, budget, compactors, model="gpt-4", summarize=None):
+    """
+    Returns a copy of `inputs` whose variables listed in `compactors` use at most `budget` tokens together.
+
+    - compactors: {variable: [callable(text) -> text, ...]}, the structural steps for each variable that
+      may be compacted. Variables not listed are left untouched.
+    - summarize: optional callable(text, max_tokens) -> text used when structural compaction is not enough.
+    """
+    inputs = dict(inputs)
+    variables = [variable for variable in compactors if variable in inputs]
+
+    def used():
+        return sum(count_tokens(inputs[variable], model) for variable in variables)
+
+    if used() <= budget:
+        return inputs
+
+    for variable in variables:
+        for compact in compactors[variable]:
+            inputs[variable] = compact(inputs[variable])
+        if used() <= budget:
+            return inputs
+
+    shares = _shares(inputs, variables, budget, model)
+    if summarize is not None:
+        for variable in variables:
+            if count_tokens(inputs[variable], model) > shares[variable]:
+                inputs[variable] = summarize(inputs[variable], shares[variable])
+        if used() <= budget:
+            return inputs
+        shares = _shares(inputs, variables, budget, model)
+
+    for variable in variables:
+        inputs[variable] = truncate_tokens(inputs[variable], shares[variable], model)
+    return inputs
+
+
+def _shares(inputs, variables, budget, model):
+    sizes = {variable: count_tokens(inputs[variable], model) for variable in variables}
+    shares = {}
+    remaining = budget
+    for left, variable in enumerate(sorted(variables, key=sizes.get)):
+        shares[variable] = max(min(sizes[variable], remaining // (len(variables) - left)), 1)
+        remaining -= shares[variable]
+    return shares
@@ -1,59 +1,70 @@
 """
 Note: Checkout the method header for process_chains() to see how to use the script.
+
+Importing this module has no side effects and does not import langchain: the prompt objects, models and
+chains are built on first use by build_prompts() and build_chains().
 """
 
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-    AIMessagePromptTemplate,
-)
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
+import asyncio
 import os
-from dotenv import load_dotenv
-from time import time
-
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
-os.environ["LANGCHAIN_API_KEY"] = "ls__ab0da2b88e6743e48e12dc5a8c9c5b22"
-os.environ["LANGCHAIN_PROJECT"] = "Explain_the_Concept_LCEL"
-
-load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
-
-
-# Input parameters - KEEP THE VARIABLES NAMES SAME AND READ IN THE VALUES FROM THE FRONT END
-course = "Data Analytics"
-background = "Software Engineering"
-name = "Raj"
-topic = "p-values"
-primary_language = "English"
-course_expertise = "Novice"
-
-# Define pass-through runnables for input variables
-course_runnable = RunnablePassthrough()
-background_runnable = RunnablePassthrough()
-topic_runnable = RunnablePassthrough()
-name_runnable = RunnablePassthrough()
-primary_language_runnable = RunnablePassthrough()
-course_expertise_runnable = RunnablePassthrough()
-
-intro_response_runnable = RunnablePassthrough()
-keyconcepts_response_runnable = RunnablePassthrough()
-application_response_runnable = RunnablePassthrough()
-example_response_runnable = RunnablePassthrough()
-analyze_response_runnable = RunnablePassthrough()
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+from concurrent.futures import ThreadPoolExecutor
+
+from context_budget import compact_key_concepts, fit_to_budget, parse_key_concepts, truncate_tables
+from llm_cache import get_default_cache, make_key
+from llm_clients import backend_config, get_llm
+from hedging import astream_hedged, atimed, get_hedge_budget, hedge_delay, stream_hedged, timed
+from metrics import measure_stage, registry
+from model_routes import AttemptClock, Route, astream_with_fallback, get_routes, stream_with_fallback
+from rate_limiter import aacquire_call, acquire_call, astream_with_retries, stream_with_retries, with_retries
+from singleflight import AsyncSingleFlight, SingleFlight
+from stage_graph import Stage, dirty_stages, input_fingerprint, run_stage_graph, share_scope
+from tracing import UNSAMPLED, start_session_trace
+
+
+@dataclass(frozen=True)
+class SessionRequest:
+    """
+    Inputs of one tutoring session, read from the front end and passed into the pipeline.
+
+    Every pipeline entry point takes one of these instead of reading module state, so many sessions
+    with different inputs can run in the same process at once.
+    """
+
+    topic: str
+    background: str
+    name: str
+    course: str
+    course_expertise: str
+    primary_language: str = "English"
+
+    def inputs(self):
+        """Returns the root variables the first stage starts from."""
+        return {
+            "topic": self.topic,
+            "background": self.background,
+            "name": self.name,
+            "course": self.course,
+            "course_expertise": self.course_expertise,
+        }
+
+
+# Session used when the script is run directly
+DEFAULT_REQUEST = SessionRequest(
+    topic="p-values",
+    background="Software Engineering",
+    name="Raj",
+    course="Data Analytics",
+    course_expertise="Novice",
+)
 
 # Model Parameters
 model = "gpt-4-1106-preview"#"gpt-4"  # "gpt-4" # "gpt-4-1106-preview"
 temperature = 0.7
 max_tokens = 256
 threshold = 0.7
-# Set Up Model
-llm = ChatOpenAI(model=model, temperature=temperature, openai_api_key=api_key)
-output_parser = StrOutputParser()
 
 
 ########## Prompt Templates
@@ -68,7 +79,6 @@ The student needs to hear your response to match their {course_expertise} level
 
 Make your responses relevant to {background}.
 """
-system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
 
 
 intro_template = """
@@ -76,11 +86,6 @@ Please briefly define and overview the topic of {topic} in {course} relevant to
 
 ONLY return a top level introduction to this topic.  Limit the output to less than 100 words.
 """
-intro_message_prompt = HumanMessagePromptTemplate.from_template(intro_template)
-
-intro_prompt = ChatPromptTemplate.from_messages(
-    [system_message_prompt, intro_message_prompt]
-)
 
 
 keyconcepts_template = """
@@ -99,7 +104,6 @@ Provide your output response in JSON format to make it easy to parse.  The JSON
 
 Limit the output to less than 300 words.
 """
-keyconcepts_prompt = ChatPromptTemplate.from_template(keyconcepts_template)
 
 
 application_template = """
@@ -108,7 +112,29 @@ Please provide a relevant example that demonstrate and clarifies each of these k
 
 Your output response should address each of the key concepts listed in the last step and how it is applied with this example.
 """
-application_prompt = ChatPromptTemplate.from_template(application_template)
+
+
+# Used instead of application_template when the application stage fans out (see fan_out_inputs()): one call per
+# key concept, all on the scenario the full list of concepts calls for, then one call to merge the sections.
+application_concept_template = """
+The key concepts of {topic} are:
+{keyconcepts_response}
+
+A tutor is writing one example that demonstrates and clarifies all of these key concepts for a student with a background in {background}. Every key concept gets its own section, and all sections use the same scenario: the most typical situation in {background} where {topic} is used, with one dataset collected in it.
+
+Please write the section for key concept {concept_number}: "{concept}". Briefly recall the scenario and the data it relies on, then explain how this key concept is applied with this example. Do not cover the other key concepts.
+"""
+
+
+application_merge_template = """
+Here are the sections of one example about {topic} for a student with a background in {background}. Each section applies one key concept to the same scenario:
+
+{concept_sections}
+
+Please tie this example together. In a few sentences, describe the one scenario these sections share and how the key concepts work together in it, then list the variables of the single dataset collected in this scenario, with their units. Where the sections describe the scenario or its data differently, settle on one version.
+
+Limit the output to less than 150 words.
+"""
 
 
 example_template = """
@@ -117,7 +143,6 @@ Please generate a sample dataset of the example you provided.  Provide this in a
 
 The format of the data should be one that can be copied and pasted into a spreadsheet like Excel.  In the end, return the same data in csv format as well so that the user can copy and paste it into a CSV file.
 """
-example_prompt = ChatPromptTemplate.from_template(example_template)
 
 
 analyze_template = """
@@ -129,7 +154,6 @@ Provide the numeric results as appropriate for each step and what the value mean
 
 Summarize the assumptions, context, limitations and interpretations to clarify the results of this analysis.
 """
-analyze_prompt = ChatPromptTemplate.from_template(analyze_template)
 
 
 visualize_template = """
@@ -140,16 +164,683 @@ Provide an explanation for each visual and its relevance to understanding the {t
 
 Provide python code needed to create the visual plots for this example. 
 """
-visualize_prompt = ChatPromptTemplate.from_template(visualize_template)
 ########## End of Prompt Templates
 
 
 # Build the LCEL Chain
 ##############################################
-def process_chains():
+# Stage order, the section title shown for each stage and the variables each prompt consumes.
+STAGES = ["intro", "keyconcepts", "application", "example", "analyze", "visualize"]
+
+STAGE_TITLES = {
+    "intro": "Introduction",
+    "keyconcepts": "Key Concepts",
+    "application": "Application",
+    "example": "Example",
+    "analyze": "Analysis",
+    "visualize": "Visualization",
+}
+
+STAGE_GRAPH = {
+    stage.name: stage
+    for stage in [
+        Stage("intro", ("topic", "background", "name", "course", "course_expertise"), "intro_response"),
+        Stage("keyconcepts", ("intro_response", "topic"), "keyconcepts_response", loose=("intro_response",)),
+        Stage("application", ("keyconcepts_response", "background", "topic"), "application_response"),
+        Stage("example", ("application_response",), "example_response"),
+        Stage(
+            "analyze",
+            ("example_response", "application_response", "keyconcepts_response"),
+            "analyze_response",
+        ),
+        Stage(
+            "visualize",
+            ("example_response", "analyze_response", "topic"),
+            "visualize_response",
+            loose=("analyze_response",),
+        ),
+    ]
+}
+
+# Inputs that are specific to one student. Stages whose prompt reads none of them are generated once
+# per shareable key and reused across students.
+PERSONAL_VARIABLES = ("name",)
+
+# Stand-in text for loosely needed inputs when stages are launched speculatively
+SPECULATIVE_DRAFTS = {
+    "intro_response": "a top level introduction to {topic} in {course}",
+    "analyze_response": "an analysis of this sample data covering each of the key concepts of {topic}",
+}
+
+
+# Token budget for the upstream outputs inlined into a stage's prompt (see context_budget.fit_to_budget).
+# Stages not listed embed a single short response and are left alone. Override with
+# AITUTOR_BUDGET_<STAGE>=<tokens>, e.g. AITUTOR_BUDGET_ANALYZE=2500.
+STAGE_INPUT_BUDGETS = {
+    "analyze": 1800,
+    "visualize": 1500,
+}
+
+# Structural compaction applied to each upstream output before falling back to summarizing/truncating
+STAGE_COMPACTORS = {
+    "keyconcepts_response": [compact_key_concepts],
+    "application_response": [truncate_tables],
+    "example_response": [truncate_tables],
+    "analyze_response": [truncate_tables],
+}
+
+# Stage that runs once per key concept, in parallel, when the key concepts can be parsed into a list.
+# AITUTOR_FANOUT_CONCURRENCY caps the calls in flight; 1 turns the fan-out off.
+FAN_OUT_STAGE = "application"
+FAN_OUT_CONCURRENCY = 4
+# Prompts of a fanned-out stage: one call per key concept, then one merging their sections
+FAN_OUT_TEMPLATES = {
+    "concept": application_concept_template,
+    "merge": application_merge_template,
+}
+FAN_OUT_MERGE_TITLE = "Putting it together"
+
+# Model used to summarize upstream outputs that are still over budget, when AITUTOR_BUDGET_SUMMARIZE=1
+SUMMARY_MODEL = "gpt-3.5-turbo"
+
+STAGE_TEMPLATES = {
+    "keyconcepts": keyconcepts_template,
+    "application": application_template,
+    "example": example_template,
+    "analyze": analyze_template,
+    "visualize": visualize_template,
+}
+
+
+@dataclass(frozen=True)
+class RoutedChain:
+    """
+    A stage's Route and the stage's LCEL chain on each of the route's models. A fanned-out stage also has
+    `parts`, the chains of each of its FAN_OUT_TEMPLATES by model.
+    """
+
+    route: Route
+    chains: dict
+    parts: dict = field(default_factory=dict)
+
+    @property
+    def primary(self):
+        return self.chains[self.route.primary]
+
+
+def stage_route(stage):
+    """
+    Returns the stage's Route in the routing table (model_routes.json, see model_routes.py). Stages missing
+    from the table run on `model` without a fallback.
+    """
+    return get_routes().get(stage) or Route(model)
+
+
+@lru_cache(maxsize=None)
+def build_prompts():
+    """Returns the chat prompt of every stage, keyed by stage name. Built once per process."""
+    from langchain.prompts.chat import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
+
+    system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
+    intro_message_prompt = HumanMessagePromptTemplate.from_template(intro_template)
+    prompts = {"intro": ChatPromptTemplate.from_messages([system_message_prompt, intro_message_prompt])}
+    for stage, template in STAGE_TEMPLATES.items():
+        prompts[stage] = ChatPromptTemplate.from_template(template)
+    for part, template in FAN_OUT_TEMPLATES.items():
+        prompts[f"{FAN_OUT_STAGE}.{part}"] = ChatPromptTemplate.from_template(template)
+    return prompts
+
+
+def chains_key():
+    """Returns what the chains are built from: the model backend configuration and every stage's route."""
+    return backend_config(), tuple((stage, stage_route(stage)) for stage in STAGES)
+
+
+def build_chains(key=None):
+    """
+    Returns a RoutedChain for every stage, keyed by stage name: the stage's route and one LCEL chain per
+    model of the route.
+
+    The chains are built once per process (and per model backend and routing table, see
+    llm_clients.backend_config and model_routes.get_routes) and shared by every session; the stages' models
+    all talk through the pooled clients of llm_clients. Each chain takes a dict holding exactly the
+    variables its stage consumes in STAGE_GRAPH. `key` defaults to the current chains_key().
+    """
+    return _build_chains(*(key or chains_key()))
+
+
+@lru_cache(maxsize=None)
+def _build_chains(config, routes):
+    from langchain_core.output_parsers import StrOutputParser
+
+    prompts = build_prompts()
+    output_parser = StrOutputParser()
+
+    def chains(prompt, route):
+        return {model: prompt | get_llm(model, temperature) | output_parser for model in route.models()}
+
+    return {
+        stage: RoutedChain(
+            route,
+            chains(prompts[stage], route),
+            {part: chains(prompts[f"{stage}.{part}"], route) for part in FAN_OUT_TEMPLATES}
+            if stage == FAN_OUT_STAGE
+            else {},
+        )
+        for stage, route in routes
+    }
+
+
+def stage_cache_key(stage, inputs, session, fans_out=None):
+    """
+    Cache key of a stage run.
+
+    Shareable stages are keyed by the stage name, the non-personal root inputs they depend on
+    (see stage_graph.share_scope) and stage_settings(), so every student with the same topic, course,
+    expertise and background shares one generation until the stage's template or settings change.
+    Personalized stages are keyed by the rendered prompt.
+    Both include the stage's model and temperature, and the model backend (llm_clients.backend_config),
+    so fake or replayed responses never land under the keys the OpenAI backend reads.
+
+    - inputs: the variables the stage consumes.
+    - session: the root inputs of the session.
+    - fans_out: whether the run fans out; defaults to what stream_stage() does with `inputs` (see
+      fan_out_inputs()). Callers that run the stage as a single call regardless pass False.
+    """
+    model = stage_route(stage).primary
+    scope = share_scope(STAGE_GRAPH, stage, session, PERSONAL_VARIABLES)
+    if scope is not None:
+        if fans_out is None:
+            fans_out = fan_out_inputs(stage, inputs) is not None
+        settings = stage_settings(stage, fans_out)
+        return make_key("shared", stage, scope, settings, model, temperature, backend_config())
+    return make_key(stage, build_prompts()[stage].format(**inputs), model, temperature, backend_config())
+
+
+def _summarize(text, max_tokens):
+    prompt = (
+        f"Summarize the following in at most {max_tokens} tokens. Keep every numbered key concept, "
+        f"table column and numeric result:\n\n{text}"
+    )
+    return with_retries(lambda: get_llm(SUMMARY_MODEL, 0).invoke(prompt)).content
+
+
+def summarize_enabled():
+    return os.getenv("AITUTOR_BUDGET_SUMMARIZE", "0") == "1"
+
+
+def stage_input_budget(stage):
+    budget = os.getenv(f"AITUTOR_BUDGET_{stage.upper()}") or STAGE_INPUT_BUDGETS.get(stage)
+    return None if budget is None else int(budget)
+
+
+def compact_stage_inputs(stage, inputs):
+    """Brings the upstream outputs in a stage's inputs under the stage's budget in STAGE_INPUT_BUDGETS."""
+    budget = stage_input_budget(stage)
+    if budget is None:
+        return inputs
+    compactors = {variable: STAGE_COMPACTORS[variable] for variable in inputs if variable in STAGE_COMPACTORS}
+    summarize = _summarize if summarize_enabled() else None
+    return fit_to_budget(inputs, budget, compactors, stage_route(stage).primary, summarize)
+
+
+def stage_settings(stage, fans_out):
+    """
+    Returns a hash of what decides a stage's output besides its inputs and model: its prompt template, its
+    input budget and compaction (see compact_stage_inputs()) and, if it runs fanned out (`fans_out`, see
+    fan_out_inputs()), the templates of its calls.
+    """
+    template = STAGE_TEMPLATES.get(stage) or system_template + intro_template
+    budget = stage_input_budget(stage)
+    compaction = None
+    if budget is not None:
+        compactors = {
+            variable: [compactor.__name__ for compactor in STAGE_COMPACTORS[variable]]
+            for variable in STAGE_GRAPH[stage].consumes
+            if variable in STAGE_COMPACTORS
+        }
+        compaction = [budget, compactors, SUMMARY_MODEL if summarize_enabled() else None]
+    return make_key(template, compaction, FAN_OUT_TEMPLATES if fans_out else None)
+
+
+def _fan_out_concurrency():
+    return int(os.getenv("AITUTOR_FANOUT_CONCURRENCY", FAN_OUT_CONCURRENCY))
+
+
+def fan_out_inputs(stage, inputs):
+    """
+    Returns the inputs of one call per key concept if `stage` is FAN_OUT_STAGE and the key concepts parse
+    into at least two entries, else None to run the stage as a single call. Each call gets the full list
+    of concepts, so all of them write about the same scenario (see application_concept_template).
+    """
+    if stage != FAN_OUT_STAGE or _fan_out_concurrency() < 2:
+        return None
+    concepts = parse_key_concepts(inputs["keyconcepts_response"])
+    if len(concepts) < 2:
+        return None
+    listed = "\n".join(f"{number}. {concept}" for number, concept in enumerate(concepts, 1))
+    return [
+        {**inputs, "keyconcepts_response": listed, "concept_number": number, "concept": concept}
+        for number, concept in enumerate(concepts, 1)
+    ]
+
+
+def merge_inputs(inputs, per_concept, sections):
+    """Returns the inputs of the call merging the `sections` written for each of `per_concept`."""
+    concept_sections = "\n\n".join(
+        f"Section {concept_inputs['concept_number']}: {concept_inputs['concept']}\n{section}"
+        for concept_inputs, section in zip(per_concept, sections)
+    )
+    return {"topic": inputs["topic"], "background": inputs["background"], "concept_sections": concept_sections}
+
+
+class Heading(str):
+    """Text the pipeline adds to a stage's output itself, so it does not count as the model's first token."""
+
+
+def _concept_heading(number, concept_inputs):
+    concept = concept_inputs["concept"]
+    title = concept.split(":")[0] if ":" in concept[:80] else " ".join(concept.split()[:8])
+    heading = f"**{number}. {title.strip()}**\n\n"
+    return Heading(heading if number == 1 else "\n\n" + heading)
+
+
+def stage_config(stage, trace):
+    """
+    Runnable config for one stage's model calls: the trace's callbacks, a `stage:<name>` tag, and the
+    cassette recorder when AITUTOR_RECORD_CASSETTE is set (see cassettes.py).
+    """
+    config = {**trace.config(), "tags": [f"stage:{stage}"]}
+    if os.getenv("AITUTOR_RECORD_CASSETTE"):
+        from cassettes import get_recorder
+
+        config["callbacks"] = [*config.get("callbacks", []), get_recorder()]
+    return config
+
+
+def _hedge(route, stage, model):
+    """
+    Returns (delay, budget) to hedge a call of `model` on `stage` (see hedging.py), or None if the call is
+    not hedged: only a route's primary with a hedge_percentile is, once its TTFT history is long enough.
+    """
+    if model != route.primary or route.hedge_percentile is None:
+        return None
+    budget = get_hedge_budget()
+    delay = hedge_delay(stage, model, route.hedge_percentile) if budget is not None else None
+    return None if delay is None else (delay, budget)
+
+
+def model_deltas(chains, stage, inputs, config, on_fallback=None, on_hedge=None):
+    """
+    Yields the model's text deltas for one stage. Transient provider errors are retried with backoff (see
+    rate_limiter.py), a stream only before its first delta; each attempt first waits for its rate-limit slot
+    (rate_limiter.acquire_call()). A primary model that still fails or misses its first-token budget is
+    replaced by the route's fallback (see model_routes.stream_with_fallback(), which calls `on_fallback`).
+    A primary that is slow to its first token may be hedged (see _hedge()); `on_hedge` is called with the
+    hedge's model when a hedge to another model wins. Time to first token and the
+    first-token budget are measured per attempt, from the moment it holds its rate-limit slot, so neither
+    includes queueing or retry backoff.
+
+    A fanned-out stage (see fan_out_inputs()) streams its first concept live while the others run on a
+    bounded thread pool, then yields the others in order under a heading per concept, and streams the call
+    merging them last. Headings are yielded as Heading deltas.
+    """
+    routed = chains[stage]
+
+    def stream(call_inputs, part=None):
+        name = stage if part is None else f"{stage}.{part}"
+        models = routed.chains if part is None else routed.parts[part]
+        prompt = build_prompts()[name].format(**call_inputs)
+        clock = AttemptClock()  # started by the primary's attempts, for its first-token budget
+
+        def call(model, clock=None):
+            def attempt():
+                call_config = acquire_call(model, prompt, config)
+                if clock is not None:
+                    clock.start()
+                try:
+                    yield from timed(models[model].stream(call_inputs, config=call_config), stage, model)
+                finally:
+                    if clock is not None:
+                        clock.stop()
+
+            return stream_with_retries(attempt)
+
+        def start(model):
+            primary_clock = clock if model == routed.route.primary else None
+            hedge = _hedge(routed.route, stage, model)
+            if hedge is None:
+                return call(model, primary_clock)
+            hedge_model = routed.route.hedge_model or model
+            labels = {"stage": stage, "model": model}
+
+            def on_winner(source):
+                if source == "hedge" and hedge_model != model and on_hedge is not None:
+                    on_hedge(hedge_model)
+
+            primary, hedged = lambda: call(model, primary_clock), lambda: call(hedge_model)
+            return stream_hedged(primary, hedged, *hedge, labels, on_winner)
+
+        return stream_with_fallback(routed.route, start, on_fallback, clock)
+
+    per_concept = fan_out_inputs(stage, inputs)
+    if per_concept is None:
+        yield from stream(inputs)
+        return
+    executor = ThreadPoolExecutor(max_workers=_fan_out_concurrency() - 1)
+    try:
+        futures = [executor.submit("".join, stream(concept_inputs, "concept")) for concept_inputs in per_concept[1:]]
+        yield _concept_heading(1, per_concept[0])
+        first = []
+        for chunk in stream(per_concept[0], "concept"):
+            first.append(chunk)
+            yield chunk
+        sections = ["".join(first)]
+        for number, (concept_inputs, future) in enumerate(zip(per_concept[1:], futures), 2):
+            yield _concept_heading(number, concept_inputs)
+            sections.append(future.result())
+            yield sections[-1]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    yield Heading(f"\n\n**{FAN_OUT_MERGE_TITLE}**\n\n")
+    yield from stream(merge_inputs(inputs, per_concept, sections), "merge")
+
+
+async def amodel_deltas(chains, stage, inputs, config, on_fallback=None, on_hedge=None):
+    """
+    Async counterpart of model_deltas(); rate-limit slots are awaited on the event loop
+    (rate_limiter.aacquire_call()) and the other concepts run as tasks bounded by a semaphore.
+    """
+    routed = chains[stage]
+
+    def astream(call_inputs, part=None):
+        name = stage if part is None else f"{stage}.{part}"
+        models = routed.chains if part is None else routed.parts[part]
+        prompt = build_prompts()[name].format(**call_inputs)
+        clock = AttemptClock()
+
+        def call(model, clock=None):
+            async def attempt():
+                call_config = await aacquire_call(model, prompt, config)
+                if clock is not None:
+                    clock.start()
+                try:
+                    deltas = models[model].astream(call_inputs, config=call_config)
+                    async for chunk in atimed(deltas, stage, model):
+                        yield chunk
+                finally:
+                    if clock is not None:
+                        clock.stop()
+
+            return astream_with_retries(attempt)
+
+        def start(model):
+            primary_clock = clock if model == routed.route.primary else None
+            hedge = _hedge(routed.route, stage, model)
+            if hedge is None:
+                return call(model, primary_clock)
+            hedge_model = routed.route.hedge_model or model
+            labels = {"stage": stage, "model": model}
+
+            def on_winner(source):
+                if source == "hedge" and hedge_model != model and on_hedge is not None:
+                    on_hedge(hedge_model)
+
+            primary, hedged = lambda: call(model, primary_clock), lambda: call(hedge_model)
+            return astream_hedged(primary, hedged, *hedge, labels, on_winner)
+
+        return astream_with_fallback(routed.route, start, on_fallback, clock)
+
+    per_concept = fan_out_inputs(stage, inputs)
+    if per_concept is None:
+        async for chunk in astream(inputs):
+            yield chunk
+        return
+    semaphore = asyncio.Semaphore(_fan_out_concurrency() - 1)
+
+    async def invoke(concept_inputs):
+        async with semaphore:
+            return "".join([chunk async for chunk in astream(concept_inputs, "concept")])
+
+    tasks = [asyncio.ensure_future(invoke(concept_inputs)) for concept_inputs in per_concept[1:]]
+    try:
+        yield _concept_heading(1, per_concept[0])
+        first = []
+        async for chunk in astream(per_concept[0], "concept"):
+            first.append(chunk)
+            yield chunk
+        sections = ["".join(first)]
+        for number, (concept_inputs, task) in enumerate(zip(per_concept[1:], tasks), 2):
+            yield _concept_heading(number, concept_inputs)
+            sections.append(await task)
+            yield sections[-1]
+    finally:
+        for task in tasks:
+            task.cancel()
+    yield Heading(f"\n\n**{FAN_OUT_MERGE_TITLE}**\n\n")
+    async for chunk in astream(merge_inputs(inputs, per_concept, sections), "merge"):
+        yield chunk
+
+
+# Stage calls in flight, shared by every session in the process (see coalesced_deltas())
+stage_flights = SingleFlight()
+async_stage_flights = AsyncSingleFlight()
+
+
+def single_flight_enabled():
+    return os.getenv("AITUTOR_SINGLE_FLIGHT", "1") != "0"
+
+
+def _flight_key(route, stage, prompt):
+    return make_key("flight", stage, prompt, route.models(), temperature, backend_config())
+
+
+def coalesced_deltas(chains, stage, inputs, prompt, trace, on_fallback=None, on_hedge=None):
+    """
+    Returns (deltas, coalesced) for one stage's model call. Identical calls in flight at the same time (same
+    stage, rendered prompt, models and temperature) share one call through stage_flights, and every caller
+    receives all of its deltas; `coalesced` is True for callers that attached to another session's call.
+    Disable with AITUTOR_SINGLE_FLIGHT=0.
+    """
+    def start():
+        return model_deltas(chains, stage, inputs, stage_config(stage, trace), on_fallback, on_hedge)
+
+    if not single_flight_enabled():
+        return start(), False
+    route = chains[stage].route
+    deltas, coalesced = stage_flights.stream(_flight_key(route, stage, prompt), start)
+    if coalesced:
+        registry.increment("aitutor_stage_coalesced_total", {"stage": stage, "model": route.primary})
+    return deltas, coalesced
+
+
+def acoalesced_deltas(chains, stage, inputs, prompt, trace, on_fallback=None, on_hedge=None):
+    """Async counterpart of coalesced_deltas(), coalescing the calls made from the running event loop."""
+    def start():
+        return amodel_deltas(chains, stage, inputs, stage_config(stage, trace), on_fallback, on_hedge)
+
+    if not single_flight_enabled():
+        return start(), False
+    route = chains[stage].route
+    deltas, coalesced = async_stage_flights.stream(_flight_key(route, stage, prompt), start)
+    if coalesced:
+        registry.increment("aitutor_stage_coalesced_total", {"stage": stage, "model": route.primary})
+    return deltas, coalesced
+
+
+def _fallback_recorder(stage, route, span, run):
+    """Returns the on_fallback callback of one stage run: relabels the run and counts the fallback."""
+    def on_fallback(reason):
+        span["fallback"] = reason
+        run.model = route.fallback
+        registry.increment("aitutor_stage_fallbacks_total", {"stage": stage, "model": route.primary, "reason": reason})
+
+    return on_fallback
+
+
+def _hedge_recorder(span, run):
+    """Returns the on_hedge callback of one stage run: relabels the run with the hedge model that won."""
+    def on_hedge(model):
+        span["hedge_model"] = run.model = model
+
+    return on_hedge
+
+
+def stream_stage(chains, stage, inputs, session, trace=UNSAMPLED, runs=None, speculative=False):
+    """
+    Streams one stage's text deltas. A cached response arrives as a single delta.
+
+    `trace` is the session's trace from tracing.start_session_trace(); the stage is recorded as one span
+    and as one run in the metrics registry. If `runs` is a dict, the run's event (timings, token counts,
+    model; see metrics.StageRun) is also stored in it under the stage name once the stage has finished.
+    Upstream outputs are compacted to the stage's input budget before they are inlined (see
+    compact_stage_inputs()), and a call identical to one already in flight attaches to it instead of
+    calling the model again (see coalesced_deltas()).
+
+    A `speculative` run (see process_stage_graph()) may have been given drafts for some of its inputs, or
+    upstream outputs generated from drafts, so it reads the cache but never writes to it.
+    """
+    cache = get_default_cache()
+    route = chains[stage].route
+    with trace.span(stage) as span, measure_stage(stage, route.primary) as run:
+        inputs = compact_stage_inputs(stage, inputs)
+        run.prompt = build_prompts()[stage].format(**inputs)
+        key = stage_cache_key(stage, inputs, session) if cache is not None else None
+        response = cache.get(key) if cache is not None else None
+        span["cached"] = run.cached = response is not None
+        if response is not None:
+            run.token(response)
+            yield response
+        else:
+            on_fallback = _fallback_recorder(stage, route, span, run)
+            on_hedge = _hedge_recorder(span, run)
+            deltas, span["coalesced"] = coalesced_deltas(
+                chains, stage, inputs, run.prompt, trace, on_fallback, on_hedge
+            )
+            for chunk in deltas:
+                run.token(chunk, generated=not isinstance(chunk, Heading))
+                yield chunk
+            response = "".join(run.parts)
+            # keyed by the primary
+            written = not span["coalesced"] and "fallback" not in span and "hedge_model" not in span
+            if cache is not None and written and not speculative:
+                cache.put(key, response)
+        span["output_chars"] = len(response)
+    if runs is not None:
+        runs[stage] = run.recorded
+
+
+def invoke_stage(chains, stage, inputs, session, trace=UNSAMPLED, speculative=False):
+    """Runs one stage to completion. Streams under the hood, so time to first token is still measured."""
+    return "".join(stream_stage(chains, stage, inputs, session, trace, speculative=speculative))
+
+
+async def astream_stage(chains, stage, inputs, session, trace=UNSAMPLED):
+    """
+    Async counterpart of stream_stage(), built on `astream`. Cache lookups and writes may go to SQLite, so
+    they run on a worker thread rather than on the event loop.
+    """
+    cache = get_default_cache()
+    route = chains[stage].route
+    with trace.span(stage) as span, measure_stage(stage, route.primary) as run:
+        if summarize_enabled():
+            inputs = await asyncio.to_thread(compact_stage_inputs, stage, inputs)
+        else:
+            inputs = compact_stage_inputs(stage, inputs)
+        run.prompt = build_prompts()[stage].format(**inputs)
+        key = stage_cache_key(stage, inputs, session) if cache is not None else None
+        response = await asyncio.to_thread(cache.get, key) if cache is not None else None
+        span["cached"] = run.cached = response is not None
+        if response is not None:
+            run.token(response)
+            yield response
+        else:
+            on_fallback = _fallback_recorder(stage, route, span, run)
+            on_hedge = _hedge_recorder(span, run)
+            deltas, span["coalesced"] = acoalesced_deltas(
+                chains, stage, inputs, run.prompt, trace, on_fallback, on_hedge
+            )
+            async for chunk in deltas:
+                run.token(chunk, generated=not isinstance(chunk, Heading))
+                yield chunk
+            response = "".join(run.parts)
+            # keyed by the primary
+            written = not span["coalesced"] and "fallback" not in span and "hedge_model" not in span
+            if cache is not None and written:
+                await asyncio.to_thread(cache.put, key, response)
+        span["output_chars"] = len(response)
+
+
+async def ainvoke_stage(chains, stage, inputs, session, trace=UNSAMPLED):
+    """Async counterpart of invoke_stage(), built on `astream`."""
+    return "".join([chunk async for chunk in astream_stage(chains, stage, inputs, session, trace)])
+
+
+def stage_inputs(stage, responses):
+    """Picks the variables consumed by `stage` out of the inputs and responses gathered so far."""
+    return {key: responses[key] for key in STAGE_GRAPH[stage].consumes}
+
+
+def session_values(request, sections):
+    """Returns the root inputs of `request` and the outputs of the stages in `sections` ({stage: text})."""
+    values = request.inputs()
+    values.update((STAGE_GRAPH[stage].produces, text) for stage, text in sections.items())
+    return values
+
+
+def regeneration_plan(request, previous):
+    """
+    Returns the stages, in STAGES order, that a session for `request` cannot take from `previous` (an
+    earlier session with `request` and `sections` attributes, such as a session_store.StoredSession): the
+    stages downstream of the inputs that changed (see stage_graph.dirty_stages) and those `previous` lacks.
+    """
+    changed = [name for name, value in request.inputs().items() if previous.request.inputs()[name] != value]
+    dirty = dirty_stages(STAGE_GRAPH, changed, PERSONAL_VARIABLES)
+    return [stage for stage in STAGES if stage in dirty or stage not in previous.sections]
+
+
+def reusable_section(stage, responses, previous, previous_values):
+    """
+    Returns the text of `stage` in `previous` if it was generated from the same inputs as the ones in
+    `responses`, compared by stage_graph.input_fingerprint(); otherwise None. `previous_values` is
+    session_values() of `previous`.
+    """
+    if previous is None or stage not in previous.sections:
+        return None
+    fingerprints = [
+        input_fingerprint(STAGE_GRAPH, stage, values, PERSONAL_VARIABLES) for values in (responses, previous_values)
+    ]
+    if fingerprints[0] != fingerprints[1]:
+        return None
+    registry.increment("aitutor_stage_reused_total", {"stage": stage})
+    return previous.sections[stage]
+
+
+def session_deltas(chains, stage, responses, trace, request, prefetch=None, runs=None):
+    """
+    Yields the deltas of `stage` for the session `request`: from `prefetch` (see prefetch.py) if it ran
+    this stage for the same request, otherwise from the stage's chain. `runs` is as for stream_stage().
+    """
+    if prefetch is not None and prefetch.covers(request, stage):
+        registry.increment("aitutor_stage_prefetched_total", {"stage": stage})
+        return prefetch.deltas(stage, runs)
+    return stream_stage(chains, stage, stage_inputs(stage, responses), responses, trace, runs)
+
+
+def process_chains(request, prefetch=None, runs=None, previous=None):
     """
     Processes a series of chains, written in LCEL format, to help a student learn a particular topic
-    given the following variables are set: course, background, name, topic, primary_language, course_expertise.
+    described by `request`, a SessionRequest holding course, background, name, topic, primary_language
+    and course_expertise. `prefetch`, optionally, is the Prefetch started for `request` while the form
+    was being filled in; the stages it covers are taken from it instead of calling the model again.
+    `runs`, optionally, is a dict that receives each stage's measured run (see stream_stage()).
+    `previous`, optionally, is an earlier session (with `request` and `sections` attributes, such as a
+    session_store.StoredSession): its stages whose inputs did not change are reused rather than
+    regenerated, so changing one input only regenerates the stages depending on it.
 
     Each chain in the sequence performs a specific function, starting with an introduction,
     then identifying key concepts, applying those concepts, providing examples, analyzing the example,
@@ -161,161 +852,173 @@ def process_chains():
 
     Example Usage from front end:
     ```python
-    from explain_the_concepts import process_chains
+    from explain_the_concepts_new import SessionRequest, process_chains
 
-    for response in process_chains():
+    request = SessionRequest(topic, background, name, course, course_expertise)
+    for response in process_chains(request):
         print(response)
     ```
 
-    Note: This function assumes that all necessary components and runnables (like `topic_runnable`,
-    `intro_prompt`, `llm`, etc.) are already defined and properly set up.
+    Note: The prompts, models and chains are built on the first call and reused afterwards
+    (see build_chains()). Per-stage latency, time to first token and token counts are recorded in
+    metrics.registry.
     """
-    start_time = time()  # to measure overall time taken
+    chains = build_chains()
+    trace = start_session_trace(request)
+    responses = request.inputs()
+    previous_values = session_values(previous.request, previous.sections) if previous is not None else None
+    for stage in STAGES:
+        response = reusable_section(stage, responses, previous, previous_values)
+        if response is None:
+            response = "".join(session_deltas(chains, stage, responses, trace, request, prefetch, runs))
+        responses[STAGE_GRAPH[stage].produces] = response
+        yield (response)
 
-    ################## CHAIN 1 ############################
-    start = time()
-    intro_chain = (
-        {
-            "topic": topic_runnable,
-            "background": background_runnable,
-            "name": name_runnable,
-            "course": course_runnable,
-            "course_expertise": course_expertise_runnable,
-        }
-        | intro_prompt
-        | ChatOpenAI(temperature=temperature, openai_api_key=api_key)
-        | output_parser
-    )
-    intro_response = intro_chain.invoke(
-        {
-            "topic": topic,
-            "background": background,
-            "name": name,
-            "course": course,
-            "course_expertise": course_expertise,
-        }
-    )
-    print(f"{'-'*40}\nIntro Response:\n{'-'*40}")
-    print(intro_response)
-    yield (intro_response)
-    end = time()
-    print(f"{'-'*20}\nTime Taken for Intro Chain: {end-start:.2f} s\n{'-'*20}\n")
-
-    ################## CHAIN 2 ############################
-    start = time()
-    keyconcepts_chain = (
-        {"intro_response": intro_response_runnable, "topic": topic_runnable}
-        | keyconcepts_prompt
-        | llm#ChatOpenAI(model = "gpt-4", temperature=temperature, openai_api_key=api_key) 
-        | output_parser
-    )
-    keyconcepts_response = keyconcepts_chain.invoke(
-        {
-            "intro_response": intro_response,
-            "topic": topic,
-        }
-    )
-    yield (keyconcepts_response)
-    print(f"{'-'*40}\nKeyconcepts Response:\n{'-'*40}")
-    print(keyconcepts_response)
-    end = time()
-    print(f"{'-'*20}\nTime Taken for Keyconcepts Chain: {end-start:.2f} s\n{'-'*20}\n")
-
-    ################## CHAIN 3 ############################
-    start = time()
-    application_chain = (
-        {
-            "keyconcepts_response": keyconcepts_response_runnable,
-            "background": background_runnable,
-        }
-        | application_prompt
-        | llm#ChatOpenAI(model = "gpt-4", temperature=temperature, openai_api_key=api_key) 
-        | output_parser
-    )
-    application_response = application_chain.invoke(
-        {"keyconcepts_response": keyconcepts_response, "background": background}
-    )
-    yield (application_response)
-    print(f"{'-'*40}\nApplication Response:\n{'-'*40}")
-    print(application_response)
-    end = time()
-    print(f"{'-'*20}\nTime Taken for Applications Chain: {end-start:.2f} s")
-
-    ################## CHAIN 4 ############################
-    start = time()
-    example_chain = (
-        {"application_response": application_response_runnable}
-        | example_prompt
-        | ChatOpenAI(temperature=temperature, openai_api_key=api_key)
-        | output_parser
-    )
-    example_response = example_chain.invoke(
-        {"application_response": application_response}
-    )
-    yield (example_response)
-    print(f"{'-'*40}\nExample Response:\n{'-'*40}")
-    print(example_response)
-    end = time()
-    print(f"{'-'*20}\nTime Taken for Example Chain: {end-start:.2f} s\n{'-'*20}\n")
-
-    ################## CHAIN 5 ############################
-    start = time()
-    analyze_chain = (
-        {
-            "example_response": example_response_runnable,
-            "application_response": application_response_runnable,
-            "keyconcepts_response": keyconcepts_response_runnable,
-        }
-        | analyze_prompt
-        | llm
-        | output_parser
-    )
-    analyze_response = analyze_chain.invoke(
-        {
-            "example_response": example_response,
-            "application_response": application_response,
-            "keyconcepts_response": keyconcepts_response,
-        }
-    )
-    yield (analyze_response)
-    print(f"{'-'*40}\nAnalyze Response:\n{'-'*40}")
-    print(analyze_response)
-    end = time()
-    print(f"{'-'*20}\nTime Taken for Analyze Chain: {end-start:.2f} s\n{'-'*20}\n")
-
-    ################## CHAIN 6 ############################
-    start = time()
-    visualize_chain = (
-        {
-            "example_response": example_response_runnable,
-            "analyze_response": analyze_response_runnable,
-            "topic": topic_runnable,
-        }
-        | visualize_prompt
-        | ChatOpenAI(model = "gpt-4", temperature=temperature, openai_api_key=api_key) #llm
-        | output_parser
-    )
-    visualize_response = visualize_chain.invoke(
-        {
-            "example_response": example_response,
-            "analyze_response": analyze_response,
-            "topic": topic,
-        }
-    )
-    yield (visualize_response)
-    print(f"{'-'*40}\nVisualize Response:\n{'-'*40}")
-    print(visualize_response)
-    end = time()
-    print(f"{'-'*20}\nTime Taken for Visualize Chain: {end-start:.2f} s\n{'-'*20}\n")
 
-    end_time = time()
-    print(f"{'*'*20}\nTotal Time Taken: {end_time-start_time:.2f} s")
+def stream_chains(request, prefetch=None, chains=None, finished=None, runs=None, previous=None):
+    """
+    Streaming variant of process_chains(): runs the same stages in the same order, but uses each
+    chain's `.stream()` so text reaches the caller as soon as the model produces it. A prefetched
+    stage still in flight is streamed as the prefetch produces it.
+
+    `chains` defaults to build_chains(). `finished` optionally maps stages the caller already has to
+    their text, e.g. from an interrupted run of the same session: those stages are not run again and
+    not yielded, and their text feeds the stages after them. `runs` and `previous` are as for
+    process_chains(); a stage reused from `previous` arrives as a single delta.
+
+    Yields:
+    - (stage, delta) tuples, where `stage` is one of STAGES and `delta` is the next piece of text
+      for that stage's section. All deltas of a stage arrive before the first delta of the next one.
+
+    Example Usage from front end:
+    ```python
+    from explain_the_concepts_new import stream_chains
+
+    for stage, delta in stream_chains(request):
+        print(delta, end="")
+    ```
+    """
+    chains = chains or build_chains()
+    finished = finished or {}
+    trace = start_session_trace(request)
+    responses = request.inputs()
+    previous_values = session_values(previous.request, previous.sections) if previous is not None else None
+    for stage in STAGES:
+        if stage in finished:
+            responses[STAGE_GRAPH[stage].produces] = finished[stage]
+            continue
+        response = reusable_section(stage, responses, previous, previous_values)
+        if response is not None:
+            responses[STAGE_GRAPH[stage].produces] = response
+            yield stage, response
+            continue
+        chunks = []
+        for chunk in session_deltas(chains, stage, responses, trace, request, prefetch, runs):
+            chunks.append(chunk)
+            yield stage, chunk
+        responses[STAGE_GRAPH[stage].produces] = "".join(chunks)
+
+
+async def aprocess_chains(request):
+    """
+    Async counterpart of process_chains(): each stage runs through ainvoke_stage(), which joins the deltas
+    of astream_stage() and so shares its cache, routing, retries and rate limiting.
+
+    The stages run in the same order and each response is yielded as soon as its stage finishes, but
+    waiting on the model no longer holds a thread, so one event loop can serve many sessions at once.
+
+    Example Usage from an async front end:
+    ```python
+    from explain_the_concepts_new import aprocess_chains
+
+    async for response in aprocess_chains(request):
+        print(response)
+    ```
+    """
+    chains = build_chains()
+    trace = start_session_trace(request)
+    responses = request.inputs()
+    for stage in STAGES:
+        response = await ainvoke_stage(chains, stage, stage_inputs(stage, responses), responses, trace)
+        responses[STAGE_GRAPH[stage].produces] = response
+        yield response
+
+
+async def astream_chains(request):
+    """
+    Async counterpart of stream_chains(), built on each chain's `astream`.
+
+    Yields:
+    - (stage, delta) tuples in the same order as stream_chains().
+    """
+    chains = build_chains()
+    trace = start_session_trace(request)
+    responses = request.inputs()
+    for stage in STAGES:
+        chunks = []
+        async for chunk in astream_stage(chains, stage, stage_inputs(stage, responses), responses, trace):
+            chunks.append(chunk)
+            yield stage, chunk
+        responses[STAGE_GRAPH[stage].produces] = "".join(chunks)
+
+
+def _speculative_draft(variable, available):
+    return SPECULATIVE_DRAFTS[variable].format(**available)
+
+
+def process_stage_graph(request, speculative=False, max_workers=None):
+    """
+    Concurrent variant of process_chains(): hands STAGE_GRAPH to the stage_graph scheduler, which
+    launches every stage as soon as the variables it consumes are ready.
+
+    With `speculative=True`, stages with a loosely needed upstream (keyconcepts on the intro,
+    visualize on the analysis) start early from the drafts in SPECULATIVE_DRAFTS, so they run
+    alongside that upstream stage instead of after it. Their outputs are not written to the response cache
+    (see stream_stage()).
+
+    Yields:
+    - (stage, response) tuples in completion order, which may differ from STAGES order.
+
+    Example Usage from front end:
+    ```python
+    from explain_the_concepts_new import process_stage_graph
+
+    for stage, response in process_stage_graph(request, speculative=True):
+        print(stage, response)
+    ```
+    """
+    chains = build_chains()
+    trace = start_session_trace(request)
+    session = request.inputs()
+
+    def run_stage(stage, inputs):
+        return invoke_stage(chains, stage.name, inputs, session, trace, speculative)
+
+    yield from run_stage_graph(
+        STAGE_GRAPH.values(),
+        run_stage,
+        session,
+        speculative=speculative,
+        draft=_speculative_draft,
+        max_workers=max_workers,
+    )
 
 
 if __name__ == "__main__":
-    for response in process_chains():
-        pass  # print(response)
+    from session_store import get_default_store
+
+    sections, runs = {}, {}
+    for stage, response in zip(STAGES, process_chains(DEFAULT_REQUEST, runs=runs)):
+        print(f"{'-'*40}\n{STAGE_TITLES[stage]}:\n{'-'*40}")
+        print(response)
         # Here, instead of printing, you can send this response to your front end
+        sections[stage] = response
+
+    store = get_default_store()
+    if store is not None:
+        print(f"Saved as session {store.save(DEFAULT_REQUEST, sections, runs)} (see session_store.py)")
+
+    print(registry.render_prometheus())
 # else:
-#     for response in process_chains():
+#     for response in process_chains(DEFAULT_REQUEST):
 #         print(response)
@@ -0,0 +1,132 @@
+"""
+Offline stand-in for the OpenAI chat models, for benchmarks and CI machines without network access.
+
+FakeChatModel is a langchain chat model that returns canned text shaped like each stage's real output
+(JSON key concepts, a sample data table, prose), streamed word by word with a configurable first-token
+delay and token rate, and with optional error injection. Select it for every stage with
+AITUTOR_LLM_BACKEND=fake (see llm_clients.get_llm), tuned through:
+- AITUTOR_FAKE_FIRST_TOKEN_DELAY: seconds before the first token (default 0);
+- AITUTOR_FAKE_TOKENS_PER_SECOND: streaming rate, 0 for no delay (default 0);
+- AITUTOR_FAKE_RESPONSE_TOKENS: length of prose responses in words (default 200);
+- AITUTOR_FAKE_ERROR_RATE: probability that a call fails with FakeLLMError (default 0).
+"""
+
+import asyncio
+import os
+import random
+import re
+import time
+import zlib
+from typing import List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+FILLER = (
+    "The p-value measures how surprising the observed data would be if the null hypothesis were true, "
+    "so a small value suggests the effect is unlikely to be due to chance alone. "
+).split()
+
+
+class FakeLLMError(RuntimeError):
+    """Error injected by FakeChatModel. Stands for a transient provider failure, so it is retried."""
+
+    retryable = True
+
+
+def canned_response(prompt, response_tokens=200):
+    """Returns deterministic text shaped like the real output of the stage `prompt` belongs to."""
+    lowered = prompt.lower()
+    if "key concepts" in lowered and "json" in lowered:
+        concepts = ["Null hypothesis", "Alternative hypothesis", "Significance level", "Test statistic", "Type I error"]
+        body = ",\n".join(
+            f'"{number}": "{concept}: {" ".join(FILLER[: 12 + number])}"' for number, concept in enumerate(concepts, 1)
+        )
+        return f"Here are the key concepts you need to be aware of.\n####\n{body}\n####"
+    if "sample dataset" in lowered:
+        rows = [f"| {day} | {100 + day * 3} | {0.02 * day:.2f} |" for day in range(1, 21)]
+        csv_rows = [f"{day},{100 + day * 3},{0.02 * day:.2f}" for day in range(1, 21)]
+        return "\n".join(
+            ["| Day | Latency (ms) | Error rate |", "|---|---|---|", *rows, "", "```csv", "Day,Latency,ErrorRate", *csv_rows, "```"]
+        )
+    words = [FILLER[index % len(FILLER)] for index in range(response_tokens)]
+    return " ".join(words)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model returning canned text with a configurable latency profile and error rate."""
+
+    model_name: str = "fake"
+    first_token_delay: float = 0.0
+    tokens_per_second: float = 0.0
+    response_tokens: int = 200
+    error_rate: float = 0.0
+    responses: Optional[List[str]] = None  # when set, one is picked per prompt instead of canned_response()
+
+    @property
+    def _llm_type(self):
+        return "fake-tutor"
+
+    @property
+    def _identifying_params(self):
+        return {
+            "model_name": self.model_name,
+            "first_token_delay": self.first_token_delay,
+            "tokens_per_second": self.tokens_per_second,
+            "response_tokens": self.response_tokens,
+        }
+
+    def _tokens(self, messages):
+        if self.error_rate and random.random() < self.error_rate:
+            raise FakeLLMError(f"Injected failure from {self.model_name}")
+        prompt = "\n".join(str(message.content) for message in messages)
+        if self.responses:
+            text = self.responses[zlib.crc32(prompt.encode("utf-8")) % len(self.responses)]
+        else:
+            text = canned_response(prompt, self.response_tokens)
+        return re.findall(r"\s*\S+", text)
+
+    def _delays(self, count):
+        """Seconds to wait before each of `count` tokens."""
+        gap = 1 / self.tokens_per_second if self.tokens_per_second else 0.0
+        return [self.first_token_delay if index == 0 else gap for index in range(count)]
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._tokens(messages)
+        for token, delay in zip(tokens, self._delays(len(tokens))):
+            if delay:
+                time.sleep(delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._tokens(messages)
+        for token, delay in zip(tokens, self._delays(len(tokens))):
+            if delay:
+                await asyncio.sleep(delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        chunks = [chunk.message.content async for chunk in self._astream(messages, stop, run_manager, **kwargs)]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(chunks)))])
+
+
+def fake_llm_from_env(model):
+    """Returns a FakeChatModel standing in for `model`, configured from the AITUTOR_FAKE_* variables."""
+    return FakeChatModel(
+        model_name=model,
+        first_token_delay=float(os.getenv("AITUTOR_FAKE_FIRST_TOKEN_DELAY", "0")),
+        tokens_per_second=float(os.getenv("AITUTOR_FAKE_TOKENS_PER_SECOND", "0")),
+        response_tokens=int(os.getenv("AITUTOR_FAKE_RESPONSE_TOKENS", "200")),
+        error_rate=float(os.getenv("AITUTOR_FAKE_ERROR_RATE", "0")),
+    )
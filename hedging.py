@@ -0,0 +1,222 @@
+"""
+Hedged model calls, to cut the latency tail of slow stages.
+
+stream_hedged() streams a model call and, if it has not produced its first delta after `delay` seconds,
+issues a duplicate call (possibly to another model) and streams whichever of the two produces a delta
+first. The other one is cancelled: it is closed at its next delta, so it costs at most one more chunk.
+
+The delay is the stage's historical time to first token at a chosen percentile (hedge_delay()), from the
+aitutor_model_ttft_seconds histogram that timed() records for every attempt of a model call, from the
+moment it holds its rate-limit slot (so queueing and retry backoff are left out). Hedging only starts once
+a stage has MIN_SAMPLES calls on record.
+
+HedgeBudget bounds the extra spend: every hedgeable call earns `ratio` of a hedge and every hedge spends a
+whole one, so at most that fraction of calls is duplicated. The process-wide budget comes from
+AITUTOR_HEDGE_BUDGET (default 0.05, 0 to disable hedging).
+"""
+
+import asyncio
+import os
+import queue
+import threading
+from time import perf_counter
+
+from metrics import registry
+
+# Calls on record before a stage's TTFT percentile is trusted to time hedges
+MIN_SAMPLES = 20
+# Never hedge sooner than this, in seconds
+MIN_DELAY = 0.05
+DEFAULT_BUDGET = 0.05
+
+
+class HedgeBudget:
+    """Allows hedging at most `ratio` of calls, with up to `burst` hedges saved up."""
+
+    def __init__(self, ratio, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.credit = 0.0
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self.credit = min(self.burst, self.credit + self.ratio)
+
+    def try_spend(self):
+        """Takes one hedge from the budget; False if none is left."""
+        with self._lock:
+            if self.credit < 1:
+                return False
+            self.credit -= 1
+            return True
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_hedge_budget():
+    """Returns the process-wide HedgeBudget from AITUTOR_HEDGE_BUDGET, or None if hedging is disabled."""
+    global _budget
+    ratio = float(os.getenv("AITUTOR_HEDGE_BUDGET", DEFAULT_BUDGET))
+    if ratio <= 0:
+        return None
+    with _budget_lock:
+        if _budget is None or _budget.ratio != ratio:
+            _budget = HedgeBudget(ratio)
+        return _budget
+
+
+def hedge_delay(stage, model, percentile):
+    """Returns the `percentile` of `model`'s time to first token on `stage`, or None without enough history."""
+    histogram = registry.histogram("aitutor_model_ttft_seconds", stage=stage, model=model)
+    if histogram is None or histogram.count < MIN_SAMPLES:
+        return None
+    return max(histogram.quantile(percentile), MIN_DELAY)
+
+
+def timed(deltas, stage, model):
+    """
+    Yields `deltas`, recording the time from the first request for a delta to the first one in
+    aitutor_model_ttft_seconds. Wrap one attempt of a call, after its rate-limit slot is taken.
+    """
+    start = perf_counter()
+    first = True
+    for chunk in deltas:
+        if first:
+            registry.observe("aitutor_model_ttft_seconds", {"stage": stage, "model": model}, perf_counter() - start)
+            first = False
+        yield chunk
+
+
+async def atimed(deltas, stage, model):
+    """Async counterpart of timed()."""
+    start = perf_counter()
+    first = True
+    async for chunk in deltas:
+        if first:
+            registry.observe("aitutor_model_ttft_seconds", {"stage": stage, "model": model}, perf_counter() - start)
+            first = False
+        yield chunk
+
+
+def _pump(source, deltas, items, abandoned):
+    """Moves the deltas of one call onto `items` as (source, kind, value) until it ends or is abandoned."""
+    try:
+        for chunk in deltas:
+            if abandoned[source]:
+                break
+            items.put((source, "delta", chunk))
+        else:
+            items.put((source, "end", None))
+    except Exception as error:
+        items.put((source, "error", error))
+    finally:
+        if hasattr(deltas, "close"):
+            deltas.close()
+
+
+def stream_hedged(start, start_hedge, delay, budget, labels, on_winner=None):
+    """
+    Yields the deltas of start(), hedged with start_hedge() if no delta arrived after `delay` seconds and
+    `budget` allows it. Both return iterators of deltas. `labels` ({"stage", "model"}) label the
+    aitutor_stage_hedges_total and aitutor_stage_hedge_wins_total counters. `on_winner` is called with the
+    source that produced the first delta, "primary" or "hedge".
+    """
+    items = queue.Queue()
+    abandoned = {"primary": False, "hedge": False}
+    threading.Thread(target=_pump, args=("primary", start(), items, abandoned), daemon=True).start()
+    budget.record_call()
+    running = {"primary"}
+    errors = []
+    winner = None
+    try:
+        try:
+            item = items.get(timeout=delay)
+        except queue.Empty:
+            item = None
+            if budget.try_spend():
+                registry.increment("aitutor_stage_hedges_total", labels)
+                threading.Thread(target=_pump, args=("hedge", start_hedge(), items, abandoned), daemon=True).start()
+                running.add("hedge")
+        while True:
+            if item is None:
+                item = items.get()
+            source, kind, value = item
+            item = None
+            if winner is None:
+                if kind == "error":
+                    errors.append(value)
+                    running.discard(source)
+                    if not running:
+                        raise errors[0]
+                    continue
+                winner = source
+                for other in running - {source}:
+                    abandoned[other] = True
+                if source == "hedge":
+                    registry.increment("aitutor_stage_hedge_wins_total", labels)
+                if on_winner is not None:
+                    on_winner(source)
+            if source != winner:
+                continue
+            if kind == "error":
+                raise value
+            if kind == "end":
+                return
+            yield value
+    finally:
+        abandoned["primary"] = abandoned["hedge"] = True
+
+
+async def astream_hedged(start, start_hedge, delay, budget, labels, on_winner=None):
+    """Async counterpart of stream_hedged(); start() and start_hedge() return async iterators."""
+    calls = {"primary": start().__aiter__()}
+    budget.record_call()
+    nexts = {asyncio.ensure_future(calls["primary"].__anext__()): "primary"}
+    done, _ = await asyncio.wait(nexts, timeout=delay)
+    if not done and budget.try_spend():
+        registry.increment("aitutor_stage_hedges_total", labels)
+        calls["hedge"] = start_hedge().__aiter__()
+        nexts[asyncio.ensure_future(calls["hedge"].__anext__())] = "hedge"
+    errors = []
+    pending = set(nexts)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                source = nexts[task]
+                try:
+                    first = task.result()
+                except StopAsyncIteration:
+                    return
+                except Exception as error:
+                    errors.append(error)
+                    continue
+                if source == "hedge":
+                    registry.increment("aitutor_stage_hedge_wins_total", labels)
+                if on_winner is not None:
+                    on_winner(source)
+                for other in pending:
+                    other.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                pending = set()
+                await _aclose(calls, exclude=source)
+                yield first
+                async for chunk in calls[source]:
+                    yield chunk
+                return
+        raise errors[0]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _aclose(calls, exclude):
+    for source, deltas in calls.items():
+        if source != exclude and hasattr(deltas, "aclose"):
+            try:
+                await deltas.aclose()
+            except Exception:
+                pass
@@ -0,0 +1,109 @@
+"""
+Import-time benchmark for the tutoring modules.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter for each module, and reports the
+cumulative import time, the slowest imports and whether any heavy dependency (langchain, openai, httpx)
+was pulled in at import. Those should only load on first use.
+
+Usage:
+    python import_benchmark.py                  # print the report
+    python import_benchmark.py -o IMPORT_TIME.md  # also write it to a file
+    python import_benchmark.py --check          # exit 1 if a heavy dependency is imported eagerly
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+MODULES = ["explain_the_concepts_new", "aitutor", "llm_clients", "llm_cache", "stage_graph", "tracing", "metrics", "context_budget", "batch_generate"]
+
+# Top-level packages that must not be imported just by importing one of MODULES
+HEAVY_PACKAGES = ("langchain", "langchain_core", "langchain_community", "openai", "httpx", "tiktoken", "streamlit")
+
+
+def measure(module, runs=5):
+    """
+    Imports `module` `runs` times in fresh interpreters and returns (best total in us, rows of the best run).
+
+    Each row is (self us, cumulative us, imported package) as reported by -X importtime.
+    """
+    best = None
+    here = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            cwd=here,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+        rows = []
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            self_us, cumulative_us, package = line[len("import time:") :].split("|")
+            rows.append((int(self_us), int(cumulative_us), package.rstrip()))
+        total = next(cumulative for _, cumulative, package in rows if package.strip() == module)
+        if best is None or total < best[0]:
+            best = (total, rows)
+    return best
+
+
+def installed_versions(packages=HEAVY_PACKAGES):
+    """Returns "package version" for each of `packages` installed, "package missing" for the others."""
+    from importlib.metadata import PackageNotFoundError, version
+
+    found = []
+    for package in packages:
+        try:
+            found.append(f"{package} {version(package.replace('_', '-'))}")
+        except PackageNotFoundError:
+            found.append(f"{package} missing")
+    return found
+
+
+def report(modules, top=8):
+    lines = [
+        "# Import-time report",
+        "",
+        f"Python {sys.version.split()[0]}, best of 5 cold imports per module.",
+        "",
+        f"Installed: {', '.join(installed_versions())}.",
+        "",
+    ]
+    heavy_found = {}
+    for module in modules:
+        total, rows = measure(module)
+        heavy = sorted({package.strip().split(".")[0] for _, _, package in rows} & set(HEAVY_PACKAGES))
+        heavy_found[module] = heavy
+        lines += [
+            f"## {module}",
+            "",
+            f"- cumulative import time: {total / 1000:.1f} ms",
+            f"- heavy dependencies imported: {', '.join(heavy) if heavy else 'none'}",
+            "",
+            "| self (ms) | cumulative (ms) | module |",
+            "|---:|---:|---|",
+        ]
+        for self_us, cumulative_us, package in sorted(rows, key=lambda row: -row[1])[:top]:
+            lines.append(f"| {self_us / 1000:.1f} | {cumulative_us / 1000:.1f} | `{package.strip()}` |")
+        lines.append("")
+    return "\n".join(lines), heavy_found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold import time of the tutoring modules.")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("-o", "--output", help="also write the markdown report to this file")
+    parser.add_argument("--check", action="store_true", help="fail if a heavy dependency is imported eagerly")
+    args = parser.parse_args()
+
+    text, heavy_found = report(args.modules)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.check and any(heavy_found.values()):
+        sys.exit(1)
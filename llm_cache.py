@@ -0,0 +1,174 @@
+"""
+Two-tier response cache for the tutoring chains: an in-memory LRU in front of an on-disk SQLite table.
+
+explain_the_concepts_new.py uses the plain get()/put() interface, keyed by stage, rendered prompt, model,
+temperature and model backend (see make_key()). aitutor.py registers the same cache with langchain through
+`set_llm_cache(as_langchain_cache(cache))`, which imports langchain only when it is called.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+DEFAULT_CACHE_PATH = ".aitutor_cache.sqlite"
+
+
+def make_key(*parts):
+    """Hashes the given parts (stage, rendered prompt, model, temperature, ...) into a cache key."""
+    return hashlib.sha256(json.dumps([str(part) for part in parts]).encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    In-memory LRU tier backed by a SQLite tier.
+
+    - max_memory_entries: number of entries kept in the LRU tier.
+    - max_disk_entries: number of rows kept on disk; the least recently used rows are evicted first.
+    - ttl: seconds an entry stays valid in either tier, None to keep entries until they are evicted.
+    - path: SQLite file, or None to run with the memory tier only.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_memory_entries=256, max_disk_entries=10000, ttl=7 * 24 * 3600):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (created_at, value)
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self._db.commit()
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key):
+        """Returns the cached text for `key`, or None on a miss."""
+        now = time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if not self._expired(created_at, now):
+                        self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                        self._remember(key, created_at, value)
+                        self.disk_hits += 1
+                        return value
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Stores `value` under `key` in both tiers."""
+        now = time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def _remember(self, key, created_at, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        (count,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_disk_entries,),
+            )
+
+    def stats(self):
+        """Returns the hit/miss counters collected since the cache was created."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        """Drops every entry from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+
+def as_langchain_cache(cache):
+    """Wraps a TieredCache in langchain's BaseCache interface, for use with set_llm_cache()."""
+    from langchain_core.caches import BaseCache
+    from langchain_core.load import dumps, loads
+
+    class LangchainTieredCache(BaseCache):
+        def lookup(self, prompt, llm_string):
+            value = cache.get(make_key("llm", prompt, llm_string))
+            if value is None:
+                return None
+            return [loads(generation) for generation in json.loads(value)]
+
+        def update(self, prompt, llm_string, return_val):
+            cache.put(make_key("llm", prompt, llm_string), json.dumps([dumps(generation) for generation in return_val]))
+
+        def clear(self, **kwargs):
+            cache.clear()
+
+    return LangchainTieredCache()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Returns the process-wide cache, created on first use, or None when caching is disabled.
+
+    Configured through the environment: AITUTOR_CACHE=0 disables caching, AITUTOR_CACHE_PATH sets the
+    SQLite file (empty for memory only) and AITUTOR_CACHE_TTL the entry lifetime in seconds.
+    """
+    global _default_cache
+    if os.getenv("AITUTOR_CACHE", "1") == "0":
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            path = os.getenv("AITUTOR_CACHE_PATH", DEFAULT_CACHE_PATH) or None
+            ttl = float(os.getenv("AITUTOR_CACHE_TTL", 7 * 24 * 3600))
+            _default_cache = TieredCache(path=path, ttl=ttl)
+        return _default_cache
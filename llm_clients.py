@@ -0,0 +1,135 @@
+"""
+Shared model clients for every stage.
+
+All ChatOpenAI objects created through get_llm() share one pair of OpenAI SDK clients, which in turn share
+one pooled keep-alive httpx connection pool (one sync, one async). A session therefore reuses warm TLS
+connections instead of opening new ones, and identical (model, temperature) pairs share one object.
+
+httpx, openai and langchain are imported on first use, so importing this module stays cheap.
+
+AITUTOR_LLM_BACKEND selects what the stages talk to: "openai" (default), "fake" for the offline
+stand-in in fake_llm.py, or "replay" to play back a recorded cassette (see cassettes.py). The backend
+settings are part of the cache key of get_llm(), so changing them in the environment takes effect on the
+next call.
+
+Every model is rate limited by rate_limiter.py (a no-op unless AITUTOR_RPM/AITUTOR_TPM are set). Retries are
+left to rate_limiter's jittered backoff, so the OpenAI SDK clients do not retry on their own.
+"""
+
+import os
+import threading
+from functools import lru_cache
+
+# Connection pool shared by every stage of every session in the process
+POOL_MAX_CONNECTIONS = 100
+POOL_MAX_KEEPALIVE_CONNECTIONS = 20
+POOL_KEEPALIVE_EXPIRY = 120
+
+
+@lru_cache(maxsize=None)
+def get_api_key():
+    """Returns OPENAI_API_KEY, loading the .env file on first use."""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return os.getenv("OPENAI_API_KEY")
+
+
+@lru_cache(maxsize=None)
+def get_openai_clients():
+    """Returns the process-wide (OpenAI, AsyncOpenAI) clients built on the pooled httpx clients."""
+    import httpx
+    import openai
+
+    limits = httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+    )
+    sync_client = openai.OpenAI(api_key=get_api_key(), http_client=httpx.Client(limits=limits), max_retries=0)
+    async_client = openai.AsyncOpenAI(api_key=get_api_key(), http_client=httpx.AsyncClient(limits=limits), max_retries=0)
+    return sync_client, async_client
+
+
+# Environment variables that configure each non-default backend
+BACKEND_SETTINGS = {
+    "fake": (
+        "AITUTOR_FAKE_FIRST_TOKEN_DELAY",
+        "AITUTOR_FAKE_TOKENS_PER_SECOND",
+        "AITUTOR_FAKE_RESPONSE_TOKENS",
+        "AITUTOR_FAKE_ERROR_RATE",
+    ),
+    "replay": ("AITUTOR_CASSETTE", "AITUTOR_REPLAY_SPEED"),
+}
+
+
+def backend_config():
+    """Returns the selected backend and its settings, as a hashable tuple."""
+    backend = os.getenv("AITUTOR_LLM_BACKEND", "openai")
+    if backend != "openai" and backend not in BACKEND_SETTINGS:
+        raise ValueError(f"Unknown AITUTOR_LLM_BACKEND {backend!r}, expected one of {['openai', *BACKEND_SETTINGS]}")
+    return (backend,) + tuple(os.getenv(name) for name in BACKEND_SETTINGS.get(backend, ()))
+
+
+def get_llm(model, temperature):
+    """Returns the shared chat model for `model` at `temperature` on the selected backend."""
+    return _create_llm(model, temperature, backend_config())
+
+
+@lru_cache(maxsize=None)
+def _create_llm(model, temperature, config):
+    from rate_limiter import as_langchain_callback
+
+    llm = _create_backend_llm(model, temperature, config)
+    llm.callbacks = [as_langchain_callback()]
+    return llm
+
+
+def _create_backend_llm(model, temperature, config):
+    if config[0] == "fake":
+        from fake_llm import fake_llm_from_env
+
+        return fake_llm_from_env(model)
+    if config[0] == "replay":
+        from cassettes import replay_llm_from_env
+
+        return replay_llm_from_env(model)
+
+    from langchain.chat_models import ChatOpenAI
+
+    sync_client, async_client = get_openai_clients()
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        openai_api_key=get_api_key(),
+        client=sync_client.chat.completions,
+        async_client=async_client.chat.completions,
+    )
+
+
+_warm_up_lock = threading.Lock()
+_warmed_up = False
+
+
+def warm_up():
+    """
+    Opens the pooled connection to the API in a background thread, so the first session does not pay
+    for the TLS handshake. Opt-in with AITUTOR_WARM_UP=1; runs at most once per process.
+    """
+    global _warmed_up
+    if os.getenv("AITUTOR_WARM_UP", "0") != "1":
+        return
+    with _warm_up_lock:
+        if _warmed_up:
+            return
+        _warmed_up = True
+
+    def request():
+        import openai
+
+        try:
+            get_openai_clients()[0].models.list()
+        except openai.OpenAIError as error:
+            print(f"Warm-up request failed: {error!r}")
+
+    threading.Thread(target=request, daemon=True).start()
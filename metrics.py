@@ -0,0 +1,246 @@
+"""
+Per-stage metrics for the tutoring pipeline.
+
+Every stage run records its wall time, time to first token, prompt and completion token counts, cache hit
+status and model. They are exposed three ways:
+- in-process histograms, summarised with p50/p95 per stage by summary();
+- Prometheus text format, from render_prometheus(), write_prometheus(path) or the HTTP endpoint started by
+  start_http_server(port) (or AITUTOR_METRICS_PORT through start_from_env());
+- a JSONL event log with one line per stage run, enabled with AITUTOR_METRICS_LOG=<path>.
+"""
+
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter, time
+
+from token_count import count_tokens
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+# Upper bounds of the token count histogram buckets
+TOKEN_BUCKETS = (50, 100, 200, 400, 800, 1200, 1600, 2400, 3200, 4800, 6400, 9600)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimates the q-quantile by interpolating inside the bucket it falls in."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """Histograms and counters keyed by metric name and label values."""
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> float
+        self.event_log = None
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def histogram(self, name, **labels):
+        """Returns the histogram for `name` and `labels`, or None if nothing was observed yet."""
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def record_stage(self, event):
+        """Records one finished stage run, as built by StageRun.event()."""
+        labels = {"stage": event["stage"], "model": event["model"]}
+        self.increment("aitutor_stage_runs_total", {**labels, "cached": str(event["cached"]).lower()})
+        if event["error"] is not None:
+            self.increment("aitutor_stage_errors_total", labels)
+        else:
+            self.observe("aitutor_stage_seconds", labels, event["wall_s"])
+            if event["ttft_s"] is not None:
+                self.observe("aitutor_stage_ttft_seconds", labels, event["ttft_s"])
+            self.observe("aitutor_stage_prompt_tokens", labels, event["prompt_tokens"], TOKEN_BUCKETS)
+            self.observe("aitutor_stage_completion_tokens", labels, event["completion_tokens"], TOKEN_BUCKETS)
+        if self.event_log is not None:
+            with self._lock, open(self.event_log, "a", encoding="utf-8") as f:
+                f.write(json.dumps(event) + "\n")
+
+    def summary(self):
+        """Returns {stage: {"p50_s", "p95_s", "ttft_p50_s", "ttft_p95_s", "runs"}} over all models."""
+        merged = {}
+        with self._lock:
+            for (name, labels), histogram in self.histograms.items():
+                if name not in ("aitutor_stage_seconds", "aitutor_stage_ttft_seconds"):
+                    continue
+                stage = dict(labels)["stage"]
+                total = merged.setdefault((name, stage), Histogram(histogram.buckets))
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.count += histogram.count
+                total.sum += histogram.sum
+        result = {}
+        for (name, stage), histogram in merged.items():
+            entry = result.setdefault(stage, {})
+            prefix = "ttft_" if name == "aitutor_stage_ttft_seconds" else ""
+            entry[f"{prefix}p50_s"] = histogram.quantile(0.5)
+            entry[f"{prefix}p95_s"] = histogram.quantile(0.95)
+            if not prefix:
+                entry["runs"] = histogram.count
+        return result
+
+    def render_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Writes render_prometheus() to `path`, e.g. for node_exporter's textfile collector."""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = MetricsRegistry()
+registry.event_log = os.getenv("AITUTOR_METRICS_LOG") or None
+
+
+class StageRun:
+    """Measurements of one stage run, filled in while the stage streams."""
+
+    def __init__(self, stage, model):
+        self.stage = stage
+        self.model = model
+        self.prompt = ""
+        self.cached = False
+        self.ttft_s = None
+        self.parts = []
+        self.recorded = None
+        self._start = perf_counter()
+
+    def token(self, delta, generated=True):
+        """
+        Records a streamed delta; the first one the model generated sets the time to first token, text the
+        pipeline adds itself (`generated` False, e.g. a heading) does not.
+        """
+        if self.ttft_s is None and generated:
+            self.ttft_s = perf_counter() - self._start
+        self.parts.append(delta)
+
+    def event(self, error=None):
+        return {
+            "time": time(),
+            "stage": self.stage,
+            "model": self.model,
+            "wall_s": perf_counter() - self._start,
+            "ttft_s": self.ttft_s,
+            "prompt_tokens": count_tokens(self.prompt, self.model),
+            "completion_tokens": count_tokens("".join(self.parts), self.model),
+            "cached": self.cached,
+            "error": error,
+        }
+
+
+@contextmanager
+def measure_stage(stage, model):
+    """
+    Measures the body as one run of `stage` on `model` and records it in the registry. After a successful
+    run, the recorded event is also kept in the run's `recorded` attribute.
+    """
+    run = StageRun(stage, model)
+    try:
+        yield run
+    except BaseException as exception:
+        registry.record_stage(run.event(error=repr(exception)))
+        raise
+    run.recorded = run.event()
+    registry.record_stage(run.recorded)
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serves render_prometheus() at http://host:port/metrics from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_from_env():
+    """Starts the /metrics endpoint on AITUTOR_METRICS_PORT, once per process, if the variable is set."""
+    global _server
+    port = os.getenv("AITUTOR_METRICS_PORT")
+    with _server_lock:
+        if port and _server is None:
+            _server = start_http_server(int(port))
+    return _server
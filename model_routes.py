@@ -0,0 +1,209 @@
+"""
+Routing table mapping each stage to the models that serve it.
+
+Each stage has a primary model, an optional fallback model and an optional latency budget: the seconds the
+primary may take to produce its first token. stream_with_fallback() streams from the primary and switches
+to the fallback when the primary fails or misses the budget; once a token has arrived, the primary finishes
+the stage, so the text a caller sees always comes from one model. With an AttemptClock, the budget only runs
+while an attempt is in flight, so time spent queueing for a rate-limit slot or backing off between retries
+does not count against it.
+
+A stage may also hedge its primary (see hedging.py): `hedge_percentile` is the percentile of the stage's
+historical time to first token after which a duplicate call goes to `hedge_model` (default: the primary).
+
+The table is read from model_routes.json next to this module, or from the file named by
+AITUTOR_MODEL_ROUTES, and reloaded when the file changes, so models can be switched without code edits:
+
+    {
+        "intro": {"primary": "gpt-3.5-turbo", "fallback": "gpt-4-1106-preview", "timeout": 5},
+        "visualize": {"primary": "gpt-4", "hedge_percentile": 0.95, "hedge_model": "gpt-4-1106-preview"}
+    }
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+DEFAULT_ROUTES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_routes.json")
+ROUTE_OPTIONS = "optional fallback, timeout, hedge_percentile and hedge_model"
+# Seconds between two checks of an AttemptClock that has no attempt in flight
+CLOCK_POLL = 0.05
+
+
+@dataclass(frozen=True)
+class Route:
+    """Models serving one stage, the primary's time-to-first-token budget in seconds, and its hedging."""
+
+    primary: str
+    fallback: Optional[str] = None
+    timeout: Optional[float] = None
+    hedge_percentile: Optional[float] = None
+    hedge_model: Optional[str] = None
+
+    def models(self):
+        models = [self.primary, self.fallback, self.hedge_model if self.hedge_percentile is not None else None]
+        return tuple(dict.fromkeys(model for model in models if model is not None))
+
+
+def load_routes(path):
+    """Reads the routing table at `path` and returns {stage: Route}."""
+    with open(path, encoding="utf-8") as f:
+        table = json.load(f)
+    routes = {}
+    for stage, entry in table.items():
+        unknown = set(entry) - set(Route.__dataclass_fields__)
+        if unknown or "primary" not in entry:
+            raise ValueError(f"Invalid route for {stage!r} in {path}: expected primary and {ROUTE_OPTIONS}, got {sorted(entry)}")
+        routes[stage] = Route(**entry)
+    return routes
+
+
+_loaded = {}  # path -> (modification time, routes)
+_loaded_lock = threading.Lock()
+
+
+def get_routes():
+    """Returns the current routing table, re-reading the file when it has changed."""
+    path = os.getenv("AITUTOR_MODEL_ROUTES", DEFAULT_ROUTES_PATH)
+    modified = os.stat(path).st_mtime_ns
+    with _loaded_lock:
+        if path not in _loaded or _loaded[path][0] != modified:
+            _loaded[path] = (modified, load_routes(path))
+        return _loaded[path][1]
+
+
+class AttemptClock:
+    """Start time of a call's current attempt: set with start() once its request is sent, cleared with stop()."""
+
+    def __init__(self, started=False):
+        self.started_at = time.monotonic() if started else None
+
+    def start(self):
+        self.started_at = time.monotonic()
+
+    def stop(self):
+        self.started_at = None
+
+    def remaining(self, timeout):
+        """Seconds left of `timeout` for the current attempt, or None while no attempt is in flight."""
+        started_at = self.started_at
+        return None if started_at is None else timeout - (time.monotonic() - started_at)
+
+
+def _first_delta(deltas, timeout, clock=None):
+    """
+    Waits for the first item of `deltas` for up to `timeout` seconds of `clock` (default: from now) and
+    returns (outcome, value), where outcome is "delta", "end", "error" or "timeout". After a timeout,
+    `deltas` is closed as soon as it yields.
+    """
+    clock = clock or AttemptClock(started=True)
+    outcome = []
+    lock = threading.Lock()
+    ready = threading.Event()
+
+    def pull():
+        try:
+            result = ("delta", next(deltas))
+        except StopIteration:
+            result = ("end", None)
+        except Exception as error:
+            result = ("error", error)
+        with lock:
+            if not outcome:
+                outcome.append(result)
+                ready.set()
+                return
+        if hasattr(deltas, "close"):
+            deltas.close()
+
+    threading.Thread(target=pull, daemon=True).start()
+    while not ready.is_set():
+        remaining = clock.remaining(timeout)
+        if remaining is not None and remaining <= 0:
+            break
+        ready.wait(CLOCK_POLL if remaining is None else remaining)
+    with lock:
+        if not outcome:
+            outcome.append(("timeout", None))
+    return outcome[0]
+
+
+def stream_with_fallback(route, start, on_fallback=None, clock=None):
+    """
+    Yields the deltas of start(route.primary), or of start(route.fallback) if the primary fails or misses
+    its first-token budget before producing anything.
+
+    - start: callable(model) returning an iterator of deltas.
+    - on_fallback: optional callable(reason), called with "error" or "timeout" when the fallback takes over.
+    - clock: optional AttemptClock that the primary's attempts start and stop; the budget then only counts
+      time with an attempt in flight. Without one, it counts from the call.
+    """
+    deltas = iter(start(route.primary))
+    if route.fallback is None:
+        yield from deltas
+        return
+    if route.timeout is None:
+        try:
+            outcome, value = "delta", next(deltas)
+        except StopIteration:
+            return
+        except Exception as error:
+            outcome, value = "error", error
+    else:
+        outcome, value = _first_delta(deltas, route.timeout, clock)
+    if outcome == "end":
+        return
+    if outcome == "delta":
+        yield value
+        yield from deltas
+        return
+    if on_fallback is not None:
+        on_fallback(outcome)
+    yield from start(route.fallback)
+
+
+async def _afirst_delta(deltas, timeout, clock=None):
+    """Async counterpart of _first_delta(); a timed-out `deltas` is cancelled rather than left running."""
+    clock = clock or AttemptClock(started=True)
+    pending = asyncio.ensure_future(deltas.__anext__())
+    while not pending.done():
+        remaining = None if timeout is None else clock.remaining(timeout)
+        if remaining is not None and remaining <= 0:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+            return "timeout", None
+        wait = None if timeout is None else CLOCK_POLL if remaining is None else remaining
+        await asyncio.wait({pending}, timeout=wait)
+    try:
+        return "delta", pending.result()
+    except StopAsyncIteration:
+        return "end", None
+    except Exception as error:
+        return "error", error
+
+
+async def astream_with_fallback(route, start, on_fallback=None, clock=None):
+    """Async counterpart of stream_with_fallback(); start(model) returns an async iterator."""
+    deltas = start(route.primary).__aiter__()
+    if route.fallback is None:
+        async for chunk in deltas:
+            yield chunk
+        return
+    outcome, first = await _afirst_delta(deltas, route.timeout, clock)
+    if outcome == "end":
+        return
+    if outcome != "delta":
+        if hasattr(deltas, "aclose"):
+            await deltas.aclose()
+        if on_fallback is not None:
+            on_fallback(outcome)
+        async for chunk in start(route.fallback):
+            yield chunk
+        return
+    yield first
+    async for chunk in deltas:
+        yield chunk
@@ -0,0 +1,155 @@
+"""
+Speculative prefetch of a session's first stages while the student is still filling in the form.
+
+The front end calls Prefetcher.update(request) with the form's current inputs on every rerun. Once the
+inputs have stayed the same for AITUTOR_PREFETCH_DELAY seconds (default 1.5), a Prefetch starts running
+the stages in AITUTOR_PREFETCH_STAGES (default "intro"; "intro,keyconcepts" also prefetches the key
+concepts) in the background. When the inputs change, the timer restarts and a prefetch of the old inputs
+is cancelled. When the session starts, Prefetcher.take(request) hands the prefetch over if it was made
+for exactly these inputs, and process_chains() / stream_chains() replay what it has produced so far and
+follow it live instead of calling the model again. AITUTOR_PREFETCH=0 disables prefetching.
+
+Every input of the intro prompt (name and background included) is part of the match, since the intro
+is personalized; a prefetch for other inputs is never shown to the student.
+"""
+
+import os
+import threading
+
+from explain_the_concepts_new import STAGE_GRAPH, build_chains, stage_inputs, stream_stage
+
+DEFAULT_DELAY = 1.5
+DEFAULT_STAGES = "intro"
+
+
+def prefetch_enabled():
+    return os.getenv("AITUTOR_PREFETCH", "1") != "0"
+
+
+class Prefetch:
+    """The first `stages` of the session for `request`, run on a background thread."""
+
+    def __init__(self, request, stages):
+        self.request = request
+        self.stages = tuple(stages)
+        self._chunks = {stage: [] for stage in self.stages}
+        self._runs = {}
+        self._finished = set()
+        self._error = None
+        self._cancelled = False
+        self._changed = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        chains = build_chains()
+        responses = self.request.inputs()
+        try:
+            for stage in self.stages:
+                deltas = stream_stage(chains, stage, stage_inputs(stage, responses), responses, runs=self._runs)
+                try:
+                    for chunk in deltas:
+                        with self._changed:
+                            if self._cancelled:
+                                return
+                            self._chunks[stage].append(chunk)
+                            self._changed.notify_all()
+                finally:
+                    deltas.close()
+                with self._changed:
+                    self._finished.add(stage)
+                    self._changed.notify_all()
+                responses[STAGE_GRAPH[stage].produces] = "".join(self._chunks[stage])
+        except Exception as error:
+            with self._changed:
+                self._error = error
+                self._changed.notify_all()
+
+    def cancel(self):
+        """Stops the prefetch at its next delta; what was produced is discarded."""
+        with self._changed:
+            self._cancelled = True
+            self._changed.notify_all()
+
+    def covers(self, request, stage):
+        """True if this prefetch can serve `stage` of the session for `request`."""
+        with self._changed:
+            return request == self.request and stage in self.stages and not self._cancelled and self._error is None
+
+    def deltas(self, stage, runs=None):
+        """
+        Yields the deltas of `stage` produced so far, then the rest as the prefetch produces them. If `runs` is
+        a dict, the stage's measured run is stored in it at the end, as by stream_stage().
+        """
+        index = 0
+        while True:
+            with self._changed:
+                while index == len(self._chunks[stage]) and stage not in self._finished and self._error is None:
+                    self._changed.wait()
+                chunks = self._chunks[stage][index:]
+                finished, error = stage in self._finished, self._error
+            index += len(chunks)
+            yield from chunks
+            if chunks:
+                continue
+            if error is not None:
+                raise error
+            if finished:
+                if runs is not None:
+                    runs[stage] = self._runs.get(stage)
+                return
+
+
+class Prefetcher:
+    """Debounces the form's inputs into at most one Prefetch, for the latest inputs."""
+
+    def __init__(self, delay=None, stages=None):
+        self.delay = float(os.getenv("AITUTOR_PREFETCH_DELAY", DEFAULT_DELAY)) if delay is None else delay
+        if stages is None:
+            stages = [stage.strip() for stage in os.getenv("AITUTOR_PREFETCH_STAGES", DEFAULT_STAGES).split(",")]
+        self.stages = tuple(stages)
+        self._request = None
+        self._timer = None
+        self._prefetch = None
+        self._lock = threading.Lock()
+
+    def update(self, request):
+        """Records the form's current inputs; a change restarts the debounce and drops the old prefetch."""
+        if not prefetch_enabled():
+            return
+        with self._lock:
+            if request == self._request:
+                return
+            self._reset()
+            self._request = request
+            if all(request.inputs().values()):
+                self._timer = threading.Timer(self.delay, self._start, args=(request,))
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _start(self, request):
+        with self._lock:
+            if request == self._request and self._prefetch is None:
+                self._prefetch = Prefetch(request, self.stages).start()
+
+    def _reset(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+            self._prefetch = None
+
+    def take(self, request):
+        """
+        Returns the prefetch for `request`, in flight or finished, or None, in which case a prefetch for
+        other inputs is cancelled. Further updates with `request` itself do not prefetch it again.
+        """
+        with self._lock:
+            prefetch = self._prefetch if self._prefetch is not None and self._prefetch.request == request else None
+            self._prefetch = None if prefetch is not None else self._prefetch
+            self._reset()
+            self._request = request
+            return prefetch
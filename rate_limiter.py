@@ -0,0 +1,366 @@
+"""
+Client-side traffic shaping for the model provider's quotas.
+
+RateLimiter budgets requests per minute and estimated tokens per minute with two token buckets, shared by
+every session in the process. Callers are served strictly in arrival order, so a large request at the head
+of the queue is not starved by smaller ones behind it. The limits apply per model, like the provider's:
+- AITUTOR_RPM / AITUTOR_TPM: requests and tokens per minute for every model (unset: unlimited);
+- AITUTOR_RPM_<MODEL> / AITUTOR_TPM_<MODEL>: override for one model, e.g. AITUTOR_TPM_GPT_4_1106_PREVIEW;
+- AITUTOR_TPM_COMPLETION_TOKENS: completion tokens reserved per request before the actual count is known.
+
+as_langchain_callback() applies the limiter to every call of the chat models built by llm_clients.get_llm():
+the call waits for its budget before the request is sent, the estimate is corrected with the actual usage
+when it ends, and a rate-limit error pauses every caller of that model for the provider's Retry-After.
+The callback waits by blocking its thread, which on langchain's async path is one of the event loop's
+executor threads; async callers take their slot ahead of the call with aacquire_call() instead, which
+waits on the loop, and pass the config it returns so the callback does not wait again.
+
+with_retries() and stream_with_retries() (and their async counterparts) retry calls that fail with a
+transient provider error, after an exponential backoff with full jitter (or the provider's Retry-After).
+A stream is only retried before its first chunk, so no caller sees text twice. AITUTOR_MAX_RETRIES sets the
+number of retries (default 4).
+"""
+
+import asyncio
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+
+from token_count import count_tokens
+
+# Completion tokens reserved for a request before its actual usage is known
+COMPLETION_TOKENS = 800
+# Backoff before retry n is uniform in [0, min(RETRY_CAP, RETRY_BASE * 2**n)] seconds
+RETRY_BASE = 1.0
+RETRY_CAP = 30.0
+
+
+class TokenBucket:
+    """Bucket of `capacity` units refilled continuously at `capacity` per `period` seconds."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` units are available (amounts above capacity wait for a full bucket)."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount):
+        self.level -= amount
+
+    def give(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits with a first-come, first-served queue."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._queue = deque()
+        self._paused_until = 0.0
+        self._changed = threading.Condition()
+        self._async_waiters = {}  # ticket -> (event loop, asyncio.Event) of the callers waiting in aacquire()
+
+    def _notify(self):
+        self._changed.notify_all()
+        for loop, changed in self._async_waiters.values():
+            loop.call_soon_threadsafe(changed.set)
+
+    def _try_acquire(self, ticket, tokens):
+        """Takes the budget and returns 0 if `ticket` is first in line and fits, else the seconds to wait."""
+        if self._queue[0] is not ticket:
+            return None
+        now = time.monotonic()
+        wait = self._paused_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        if wait > 0:
+            return wait
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+        self._queue.popleft()
+        self._notify()
+        return 0
+
+    def _leave(self, ticket):
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            self._notify()
+
+    def acquire(self, tokens=0):
+        """Blocks until it is this caller's turn and the buckets hold one request and `tokens` tokens."""
+        ticket = object()
+        with self._changed:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    wait = self._try_acquire(ticket, tokens)
+                    if wait == 0:
+                        return
+                    self._changed.wait(wait)
+            except BaseException:
+                self._leave(ticket)
+                raise
+
+    async def aacquire(self, tokens=0):
+        """Async counterpart of acquire(): waits on the event loop, in the same queue as acquire()."""
+        ticket = object()
+        changed = asyncio.Event()
+        with self._changed:
+            self._queue.append(ticket)
+            self._async_waiters[ticket] = (asyncio.get_running_loop(), changed)
+        try:
+            while True:
+                with self._changed:
+                    wait = self._try_acquire(ticket, tokens)
+                    changed.clear()
+                if wait == 0:
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._changed:
+                self._leave(ticket)
+            raise
+        finally:
+            with self._changed:
+                del self._async_waiters[ticket]
+
+    def settle(self, reserved, used):
+        """Corrects a reservation of `reserved` tokens once the request is known to have used `used`."""
+        if self.tokens is None:
+            return
+        with self._changed:
+            if used < reserved:
+                self.tokens.give(reserved - used)
+            else:
+                self.tokens.take(used - reserved)
+            self._notify()
+
+    def pause(self, seconds):
+        """Holds every caller for `seconds`, e.g. after the provider answered 429."""
+        with self._changed:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._notify()
+
+    def waiting(self):
+        """Returns the number of callers waiting for their turn."""
+        with self._changed:
+            return len(self._queue)
+
+
+def _model_setting(name, model):
+    value = os.getenv(f"{name}_{re.sub(r'[^0-9A-Za-z]', '_', model).upper()}") or os.getenv(name)
+    return float(value) if value else None
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model):
+    """Returns the process-wide RateLimiter for `model`, or None if it has no limits configured."""
+    limits = (_model_setting("AITUTOR_RPM", model), _model_setting("AITUTOR_TPM", model))
+    if limits == (None, None):
+        return None
+    with _limiters_lock:
+        if (model, limits) not in _limiters:
+            _limiters[(model, limits)] = RateLimiter(*limits)
+        return _limiters[(model, limits)]
+
+
+def completion_tokens():
+    return int(os.getenv("AITUTOR_TPM_COMPLETION_TOKENS", COMPLETION_TOKENS))
+
+
+# Config metadata of a call whose slot was taken by acquire_call() / aacquire_call()
+RESERVATION_KEY = "aitutor_rate_limit_reservation"
+
+
+def _reservation(model, prompt, config):
+    """Returns (limiter, tokens to reserve, `config` marked as holding the reservation) for a call of `model`."""
+    limiter = get_limiter(model)
+    if limiter is None:
+        return None, 0, config
+    prompt_tokens = count_tokens(prompt, model)
+    reserved = prompt_tokens + completion_tokens()
+    metadata = {**(config.get("metadata") or {}), RESERVATION_KEY: [prompt_tokens, reserved]}
+    return limiter, reserved, {**config, "metadata": metadata}
+
+
+def acquire_call(model, prompt, config):
+    """
+    Waits for `model`'s budget for a call with `prompt` and returns `config` (a runnable config) marked so
+    that the langchain callback does not wait again when the call starts. The call must run with it.
+    """
+    limiter, reserved, config = _reservation(model, prompt, config)
+    if limiter is not None:
+        limiter.acquire(reserved)
+    return config
+
+
+async def aacquire_call(model, prompt, config):
+    """Async counterpart of acquire_call(): waits on the event loop rather than blocking a thread."""
+    limiter, reserved, config = _reservation(model, prompt, config)
+    if limiter is not None:
+        await limiter.aacquire(reserved)
+    return config
+
+
+def is_rate_limit(error):
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.RateLimitError)
+
+
+def is_retryable(error):
+    """True for transient provider errors: rate limits, timeouts, connection and server errors."""
+    openai = sys.modules.get("openai")  # only loaded if a real model was used
+    if openai is not None and isinstance(
+        error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+    ):
+        return True
+    return getattr(error, "retryable", False)
+
+
+def retry_after(error):
+    """Returns the provider's Retry-After for `error` in seconds, or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def max_retries():
+    return int(os.getenv("AITUTOR_MAX_RETRIES", "4"))
+
+
+def backoff(attempt, error=None):
+    """Seconds to wait before retry number `attempt` (0-based) after `error`."""
+    delay = retry_after(error) if error is not None else None
+    if delay is not None:
+        return delay
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2**attempt))
+
+
+def with_retries(call):
+    """Returns call(), retrying transient provider errors up to AITUTOR_MAX_RETRIES times."""
+    for attempt in range(max_retries() + 1):
+        try:
+            return call()
+        except Exception as error:
+            if attempt == max_retries() or not is_retryable(error):
+                raise
+            time.sleep(backoff(attempt, error))
+
+
+async def awith_retries(call):
+    """Async counterpart of with_retries(); `call` returns an awaitable."""
+    for attempt in range(max_retries() + 1):
+        try:
+            return await call()
+        except Exception as error:
+            if attempt == max_retries() or not is_retryable(error):
+                raise
+            await asyncio.sleep(backoff(attempt, error))
+
+
+def stream_with_retries(start):
+    """Yields the chunks of start(), starting it again on a transient error raised before the first chunk."""
+    for attempt in range(max_retries() + 1):
+        started = False
+        try:
+            for chunk in start():
+                started = True
+                yield chunk
+            return
+        except Exception as error:
+            if started or attempt == max_retries() or not is_retryable(error):
+                raise
+            time.sleep(backoff(attempt, error))
+
+
+async def astream_with_retries(start):
+    """Async counterpart of stream_with_retries(); start() returns an async iterator."""
+    for attempt in range(max_retries() + 1):
+        started = False
+        try:
+            async for chunk in start():
+                started = True
+                yield chunk
+            return
+        except Exception as error:
+            if started or attempt == max_retries() or not is_retryable(error):
+                raise
+            await asyncio.sleep(backoff(attempt, error))
+
+
+def as_langchain_callback():
+    """Returns a langchain callback handler applying get_limiter() to every chat model call it sees."""
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class RateLimitCallback(BaseCallbackHandler):
+        raise_error = True  # a failed wait must fail the call rather than be logged and ignored
+
+        def __init__(self):
+            self._runs = {}
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            params = kwargs.get("invocation_params") or {}
+            model = params.get("model") or params.get("model_name") or ""
+            limiter = get_limiter(model)
+            if limiter is None:
+                return
+            reservation = (kwargs.get("metadata") or {}).get(RESERVATION_KEY)
+            if reservation is not None:  # the caller already waited, see acquire_call()
+                prompt_tokens, reserved = reservation
+            else:
+                prompt = "\n".join(str(message.content) for message in messages[0])
+                prompt_tokens = count_tokens(prompt, model)
+                reserved = prompt_tokens + completion_tokens()
+                limiter.acquire(reserved)
+            self._runs[run_id] = (limiter, model, prompt_tokens, reserved)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            run = self._runs.pop(run_id, None)
+            if run is None:
+                return
+            limiter, model, prompt_tokens, reserved = run
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            used = usage.get("total_tokens")
+            if used is None:
+                text = "".join(generation.text for generations in response.generations for generation in generations)
+                used = prompt_tokens + count_tokens(text, model)
+            limiter.settle(reserved, used)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            run = self._runs.pop(run_id, None)
+            if run is None:
+                return
+            limiter, _, _, reserved = run
+            if is_rate_limit(error):
+                limiter.settle(reserved, 0)
+                limiter.pause(backoff(0, error))
+
+    return RateLimitCallback()
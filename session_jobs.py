@@ -0,0 +1,148 @@
+"""
+Background execution of tutoring sessions for the front end.
+
+Streamlit aborts a script run whenever the student touches a widget, so app.py does not run the pipeline
+itself: SessionJobs.submit() hands the session to a bounded pool of worker threads
+(AITUTOR_SESSION_WORKERS, default 4) and each script run only renders the job's sections and polls until
+it is done. A rerun finds the job still running and keeps rendering it, so no model call is lost or made
+twice.
+
+Finished sessions are saved to the session store (see session_store.py), and a session whose inputs are
+already stored is loaded from it instead of being generated again. When a student changes some inputs, the
+new session reuses the sections of the previous one that do not depend on them.
+"""
+
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from explain_the_concepts_new import STAGES, regeneration_plan, stream_chains
+from session_store import StoredSession, get_default_store
+
+DEFAULT_WORKERS = 4
+
+
+class SessionJob:
+    """One session queued or running on the pool; its sections grow as the pipeline streams them."""
+
+    def __init__(self, request, finished=None, previous=None):
+        self.request = request
+        self.finished = dict(finished or {})  # stage -> text of every finished stage
+        self.sections = dict(self.finished)  # stage -> text so far, in STAGES order
+        self.runs = {}  # stage -> measured run of every stage generated by this job
+        self.previous = previous  # earlier session whose unaffected sections are reused
+        # Stages that are generated rather than taken from `finished` or `previous`
+        self.regenerating = [stage for stage in STAGES if stage not in self.finished]
+        if previous is not None:
+            self.regenerating = [stage for stage in regeneration_plan(request, previous) if stage not in self.finished]
+        self.session_id = None  # id in the session store, once saved
+        self.created_at = time()
+        self.error = None
+        self.done = False
+        self.future = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def stored(cls, session):
+        """Returns a finished job holding the StoredSession `session`."""
+        job = cls(session.request, session.sections)
+        job.runs = session.runs
+        job.session_id = session.session_id
+        job.created_at = session.created_at
+        job.regenerating = []
+        job.done = True
+        return job
+
+    def finished_session(self):
+        """Returns the sections finished so far as a StoredSession, e.g. to be the `previous` of a new job."""
+        with self._lock:
+            return StoredSession(self.session_id, self.request, self.created_at, dict(self.finished), dict(self.runs))
+
+    def run(self, prefetch=None, chains=None, store=None):
+        streaming = None
+        try:
+            deltas = stream_chains(
+                self.request, prefetch, chains, finished=dict(self.finished), runs=self.runs, previous=self.previous
+            )
+            try:
+                for stage, delta in deltas:
+                    with self._lock:
+                        if self._cancelled:
+                            return
+                        if stage != streaming:
+                            if streaming is not None:
+                                self.finished[streaming] = self.sections[streaming]
+                            streaming = stage
+                            self.sections[stage] = ""
+                        self.sections[stage] += delta
+            finally:
+                deltas.close()
+            with self._lock:
+                if streaming is not None:
+                    self.finished[streaming] = self.sections[streaming]
+            if store is not None:
+                self.session_id = store.save(self.request, self.finished, self.runs)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.done = True
+
+    def cancel(self):
+        """Stops the job at its next delta, or before it starts if it is still queued."""
+        with self._lock:
+            self._cancelled = True
+        if self.future is not None and self.future.cancel():
+            self.done = True
+
+    def snapshot(self):
+        """Returns {stage: text} for every section started so far; the last one may still be growing."""
+        with self._lock:
+            return dict(self.sections)
+
+
+class SessionJobs:
+    """Bounded worker pool running at most one SessionJob per front-end session."""
+
+    def __init__(self, max_workers=None, store=None):
+        max_workers = max_workers or int(os.getenv("AITUTOR_SESSION_WORKERS", DEFAULT_WORKERS))
+        self.store = store if store is not None else get_default_store()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="session")
+        self._jobs = weakref.WeakValueDictionary()  # session -> SessionJob, alive while the session holds it
+        self._lock = threading.Lock()
+
+    def get(self, session):
+        return self._jobs.get(session)
+
+    def submit(self, session, request, prefetch=None, chains=None):
+        """
+        Returns the job of `session` for `request`: the current one if it is for the same inputs and has not
+        failed, otherwise a new one. A job for other inputs is cancelled and its finished sections are reused
+        where the changed inputs do not affect them; a failed job for the same inputs is resumed after its
+        finished sections, and inputs found in the store are loaded rather than generated. The caller keeps
+        the job alive by holding a reference to it.
+
+        `prefetch` (see prefetch.py) is handed to the new job, or cancelled if no job is started.
+        """
+        with self._lock:
+            job = self._jobs.get(session)
+            if job is not None and job.request == request and job.error is None and not job._cancelled:
+                if prefetch is not None:
+                    prefetch.cancel()
+                return job
+            finished = job.finished if job is not None and job.request == request else None
+            previous = job.finished_session() if job is not None and job.request != request else None
+            if job is not None:
+                job.cancel()
+            stored = self.store.find(request) if self.store is not None and not finished else None
+            if stored is not None and all(stage in stored.sections for stage in STAGES):
+                job = SessionJob.stored(stored)
+                if prefetch is not None:
+                    prefetch.cancel()
+            else:
+                job = SessionJob(request, finished, previous)
+                job.future = self.executor.submit(job.run, prefetch, chains, self.store)
+            self._jobs[session] = job
+            return job
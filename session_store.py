@@ -0,0 +1,271 @@
+"""
+Durable store of generated tutoring sessions.
+
+Every finished session is saved with its inputs, the text of each stage, and the stage's timings, token
+counts and model (the event of its metrics.StageRun), so a student reopening it or an instructor reviewing
+it loads it from storage instead of regenerating it.
+
+Stores share one interface (save, load, find, sessions):
+- SqliteSessionStore (default) keeps sessions in one SQLite file. Stage texts are compressed, with zstd
+  when the `zstandard` package is installed and zlib otherwise, and sessions are indexed on
+  (course, topic, course_expertise, background) for lookups by inputs.
+- MemorySessionStore keeps them in memory, for tests and single-process deployments.
+
+get_default_store() is configured through the environment: AITUTOR_SESSION_STORE selects "sqlite" or
+"memory" ("0" disables the store) and AITUTOR_SESSION_STORE_PATH sets the SQLite file.
+
+Run as a script to review stored sessions:
+
+    python session_store.py --course "Data Analytics" --topic p-values
+    python session_store.py --show <session id>
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from time import time
+
+from explain_the_concepts_new import STAGE_TITLES, SessionRequest
+
+DEFAULT_STORE_PATH = ".aitutor_sessions.sqlite"
+# Inputs sessions are indexed and searched on, most selective first
+INDEXED_INPUTS = ("course", "topic", "course_expertise", "background")
+# Fields of a stage's measured run stored next to its text
+RUN_FIELDS = ("model", "wall_s", "ttft_s", "prompt_tokens", "completion_tokens", "cached")
+
+
+@dataclass
+class StoredSession:
+    """A saved session: its inputs, the text of each stage in STAGES order, and each stage's run."""
+
+    session_id: str
+    request: SessionRequest
+    created_at: float
+    sections: dict = field(default_factory=dict)  # stage -> text
+    runs: dict = field(default_factory=dict)  # stage -> {model, wall_s, ttft_s, prompt_tokens, ...}
+
+
+def _run_fields(run):
+    return {name: (run or {}).get(name) for name in RUN_FIELDS}
+
+
+def compress(text):
+    """Returns (codec, blob): `text` compressed with zstd if available, else zlib."""
+    data = text.encode("utf-8")
+    try:
+        import zstandard
+    except ImportError:
+        return "zlib", zlib.compress(data, 6)
+    return "zstd", zstandard.ZstdCompressor(level=6).compress(data)
+
+
+def decompress(codec, blob):
+    if codec == "zlib":
+        return zlib.decompress(blob).decode("utf-8")
+    if codec == "zstd":
+        import zstandard  # a store written with zstd needs the package to be read
+
+        return zstandard.ZstdDecompressor().decompress(blob).decode("utf-8")
+    raise ValueError(f"Unknown session codec {codec!r}")
+
+
+class SqliteSessionStore:
+    """Sessions in a SQLite file: one row per session and one row per stage, with compressed texts."""
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, created_at REAL NOT NULL, course TEXT NOT NULL, topic TEXT NOT NULL, "
+            "course_expertise TEXT NOT NULL, background TEXT NOT NULL, name TEXT NOT NULL, "
+            "primary_language TEXT NOT NULL)"
+        )
+        self._db.execute(
+            f"CREATE INDEX IF NOT EXISTS sessions_inputs ON sessions ({', '.join(INDEXED_INPUTS)}, created_at)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS session_stages ("
+            "session_id TEXT NOT NULL, "
+            "position INTEGER NOT NULL, stage TEXT NOT NULL, codec TEXT NOT NULL, text BLOB NOT NULL, "
+            "model TEXT, wall_s REAL, ttft_s REAL, prompt_tokens INTEGER, completion_tokens INTEGER, cached INTEGER, "
+            "PRIMARY KEY (session_id, position))"
+        )
+        self._db.commit()
+
+    def save(self, request, sections, runs=None):
+        """Saves a session's `sections` ({stage: text}) and stage `runs`; returns the new session id."""
+        session_id = uuid.uuid4().hex
+        runs = runs or {}
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    session_id,
+                    time(),
+                    request.course,
+                    request.topic,
+                    request.course_expertise,
+                    request.background,
+                    request.name,
+                    request.primary_language,
+                ),
+            )
+            self._db.executemany(
+                "INSERT INTO session_stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, position, stage, *compress(text), *_run_fields(runs.get(stage)).values())
+                    for position, (stage, text) in enumerate(sections.items())
+                ],
+            )
+            self._db.commit()
+        return session_id
+
+    def _session(self, row):
+        session_id, created_at, course, topic, course_expertise, background, name, primary_language = row
+        request = SessionRequest(topic, background, name, course, course_expertise, primary_language)
+        session = StoredSession(session_id, request, created_at)
+        rows = self._db.execute(
+            f"SELECT stage, codec, text, {', '.join(RUN_FIELDS)} FROM session_stages "
+            "WHERE session_id = ? ORDER BY position",
+            (session_id,),
+        )
+        for stage, codec, blob, *run in rows:
+            session.sections[stage] = decompress(codec, blob)
+            session.runs[stage] = run = dict(zip(RUN_FIELDS, run))
+            if run["cached"] is not None:
+                run["cached"] = bool(run["cached"])
+        return session
+
+    def load(self, session_id):
+        """Returns the StoredSession with `session_id`, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            return self._session(row) if row is not None else None
+
+    def find(self, request):
+        """Returns the latest StoredSession generated for exactly the inputs of `request`, or None."""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT * FROM sessions WHERE {' AND '.join(f'{name} = ?' for name in INDEXED_INPUTS)} "
+                "AND name = ? AND primary_language = ? ORDER BY created_at DESC LIMIT 1",
+                (*(getattr(request, name) for name in INDEXED_INPUTS), request.name, request.primary_language),
+            ).fetchone()
+            return self._session(row) if row is not None else None
+
+    def sessions(self, limit=50, **inputs):
+        """
+        Returns up to `limit` StoredSessions, latest first, without their texts or runs. `inputs` filters on
+        any of INDEXED_INPUTS, e.g. sessions(course="Data Analytics", topic="p-values").
+        """
+        unknown = set(inputs) - set(INDEXED_INPUTS)
+        if unknown:
+            raise ValueError(f"Sessions can be filtered on {', '.join(INDEXED_INPUTS)}, not {', '.join(sorted(unknown))}")
+        names = [name for name in INDEXED_INPUTS if name in inputs]
+        where = f"WHERE {' AND '.join(f'{name} = ?' for name in names)} " if names else ""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM sessions {where}ORDER BY created_at DESC LIMIT ?",
+                (*(inputs[name] for name in names), limit),
+            ).fetchall()
+        return [
+            StoredSession(session_id, SessionRequest(topic, background, name, course, expertise, language), created_at)
+            for session_id, created_at, course, topic, expertise, background, name, language in rows
+        ]
+
+
+class MemorySessionStore:
+    """Sessions kept in memory, with the same interface as SqliteSessionStore."""
+
+    def __init__(self):
+        self._sessions = {}  # session id -> StoredSession, in insertion order
+        self._lock = threading.Lock()
+
+    def save(self, request, sections, runs=None):
+        session = StoredSession(uuid.uuid4().hex, request, time(), dict(sections))
+        session.runs = {stage: _run_fields((runs or {}).get(stage)) for stage in sections}
+        with self._lock:
+            self._sessions[session.session_id] = session
+        return session.session_id
+
+    def load(self, session_id):
+        return self._sessions.get(session_id)
+
+    def find(self, request):
+        with self._lock:
+            matches = [session for session in self._sessions.values() if session.request == request]
+        return matches[-1] if matches else None
+
+    def sessions(self, limit=50, **inputs):
+        with self._lock:
+            matches = [
+                StoredSession(session.session_id, session.request, session.created_at)
+                for session in reversed(self._sessions.values())
+                if all(getattr(session.request, name) == value for name, value in inputs.items())
+            ]
+        return matches[:limit]
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store():
+    """Returns the process-wide session store, created on first use, or None when it is disabled."""
+    global _default_store
+    kind = os.getenv("AITUTOR_SESSION_STORE", "sqlite")
+    if kind == "0":
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            if kind == "memory":
+                _default_store = MemorySessionStore()
+            elif kind == "sqlite":
+                _default_store = SqliteSessionStore(os.getenv("AITUTOR_SESSION_STORE_PATH", DEFAULT_STORE_PATH))
+            else:
+                raise ValueError(f"Unknown AITUTOR_SESSION_STORE {kind!r}: expected sqlite, memory or 0")
+        return _default_store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List or show stored tutoring sessions.")
+    for name in INDEXED_INPUTS:
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, help=f"only sessions with this {name}")
+    parser.add_argument("--limit", type=int, default=50, help="sessions listed (default 50)")
+    parser.add_argument("--show", metavar="SESSION_ID", help="print one session's sections and stage runs")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of text")
+    args = parser.parse_args(argv)
+
+    store = get_default_store()
+    if store is None:
+        parser.error("the session store is disabled (AITUTOR_SESSION_STORE=0)")
+    if args.show:
+        session = store.load(args.show)
+        if session is None:
+            parser.error(f"no session {args.show}")
+        if args.json:
+            print(json.dumps({**session.request.__dict__, "sections": session.sections, "runs": session.runs}))
+            return 0
+        for stage, text in session.sections.items():
+            run = session.runs.get(stage, {})
+            print(f"{'-'*40}\n{STAGE_TITLES.get(stage, stage)} ({run.get('model')}, {run.get('wall_s') or 0:.2f}s):\n{'-'*40}")
+            print(text)
+        return 0
+
+    inputs = {name: getattr(args, name) for name in INDEXED_INPUTS if getattr(args, name) is not None}
+    for session in store.sessions(limit=args.limit, **inputs):
+        request = session.request
+        if args.json:
+            print(json.dumps({"session_id": session.session_id, "created_at": session.created_at, **request.__dict__}))
+        else:
+            print(f"{session.session_id}  {request.course} / {request.topic} ({request.course_expertise}, {request.background})")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
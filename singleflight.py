@@ -0,0 +1,162 @@
+"""
+Coalesces identical in-flight calls, so concurrent sessions asking for the same thing share one model call.
+
+SingleFlight.stream(key, start) returns the deltas of the call for `key`: the first caller starts it with
+`start()` and every caller arriving while it still runs attaches to it. Each of them receives every delta
+from the beginning, as soon as it arrives, and the call's exception if it fails. The call runs on its own
+thread, so it does not depend on the caller that started it, and stops early only once every caller has
+stopped reading. When it ends, the next caller for `key` starts a new one.
+
+AsyncSingleFlight is the asyncio counterpart, coalescing the calls made from one event loop.
+"""
+
+import asyncio
+import threading
+
+
+class Flight:
+    """One in-flight call: the deltas produced so far and how it ended."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 1
+
+
+class SingleFlight:
+    """Thread-safe registry of in-flight calls by key."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def stream(self, key, start):
+        """
+        Returns (deltas, joined): an iterator over the deltas of the call for `key`, and whether it attached
+        to a call another caller had already started.
+
+        - start: callable returning an iterator of deltas, called on a new thread if no call is in flight.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                return self._read(key, flight), True
+            flight = self._flights[key] = Flight()
+        threading.Thread(target=self._run, args=(key, flight, start), daemon=True).start()
+        return self._read(key, flight), False
+
+    def _run(self, key, flight, start):
+        deltas = None
+        try:
+            deltas = start()
+            for chunk in deltas:
+                with self._lock:
+                    flight.chunks.append(chunk)
+                    self._changed.notify_all()
+                    if not flight.subscribers:
+                        break
+        except BaseException as error:
+            flight.error = error
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.done = True
+                self._changed.notify_all()
+            if hasattr(deltas, "close"):
+                deltas.close()
+
+    def _read(self, key, flight):
+        index = 0
+        try:
+            while True:
+                with self._lock:
+                    while index == len(flight.chunks) and not flight.done:
+                        self._changed.wait()
+                    chunks = flight.chunks[index:]
+                    done = flight.done
+                index += len(chunks)
+                yield from chunks
+                if done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            with self._lock:
+                flight.subscribers -= 1
+                if not flight.subscribers and self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def in_flight(self):
+        """Returns the number of calls currently in flight."""
+        with self._lock:
+            return len(self._flights)
+
+
+class AsyncSingleFlight:
+    """Registry of in-flight async calls by event loop and key; each loop coalesces its own calls."""
+
+    def __init__(self):
+        self._flights = {}
+
+    def stream(self, key, start):
+        """
+        Async counterpart of SingleFlight.stream(); returns (async iterator of deltas, joined).
+
+        - start: callable returning an async iterator of deltas, run as a task if no call is in flight.
+        """
+        key = (asyncio.get_running_loop(), key)
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.subscribers += 1
+            return self._read(key, flight), True
+        flight = self._flights[key] = Flight()
+        flight.changed = asyncio.Event()
+        flight.task = asyncio.ensure_future(self._run(key, flight, start))  # keeps the task referenced
+        return self._read(key, flight), False
+
+    def _notify(self, flight):
+        flight.changed.set()
+        flight.changed = asyncio.Event()
+
+    async def _run(self, key, flight, start):
+        deltas = None
+        try:
+            deltas = start()
+            async for chunk in deltas:
+                flight.chunks.append(chunk)
+                self._notify(flight)
+                if not flight.subscribers:
+                    break
+        except BaseException as error:
+            flight.error = error
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done = True
+            self._notify(flight)
+            if hasattr(deltas, "aclose"):
+                await deltas.aclose()
+
+    async def _read(self, key, flight):
+        index = 0
+        try:
+            while True:
+                while index == len(flight.chunks) and not flight.done:
+                    await flight.changed.wait()
+                chunks = flight.chunks[index:]
+                done = flight.done
+                index += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                if done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and self._flights.get(key) is flight:
+                del self._flights[key]
@@ -0,0 +1,175 @@
+"""
+Declarative description of the tutoring stages and a scheduler that runs them as soon as their inputs are ready.
+
+Each Stage lists the variables its prompt consumes and the variable it produces. run_stage_graph() walks
+the graph with a thread pool, so stages that do not depend on each other run concurrently and the
+end-to-end latency becomes the critical path of the graph rather than the sum of every stage.
+"""
+
+import hashlib
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    One node of the stage graph.
+
+    - name: stage name, e.g. "intro".
+    - consumes: variables the stage's prompt needs.
+    - produces: variable the stage's output is stored under, e.g. "intro_response".
+    - loose: subset of `consumes` the stage only loosely needs. In speculative mode the stage may be
+      launched before these are ready, with a draft value standing in for them.
+    """
+
+    name: str
+    consumes: tuple
+    produces: str
+    loose: tuple = ()
+
+    @property
+    def required(self):
+        """Variables that must be ready before the stage can run, even speculatively."""
+        return tuple(variable for variable in self.consumes if variable not in self.loose)
+
+    def personalized(self, personal_variables):
+        """True if the stage's own prompt reads one of the per-student `personal_variables`."""
+        return any(variable in personal_variables for variable in self.consumes)
+
+
+def root_variables(stages, name):
+    """
+    Returns the root inputs (variables no stage produces) that stage `name` depends on, directly or
+    through the outputs of its upstream stages.
+
+    `stages` is a dict of stage name -> Stage.
+    """
+    producers = {stage.produces: stage for stage in stages.values()}
+    roots = set()
+    to_visit = [stages[name]]
+    while to_visit:
+        stage = to_visit.pop()
+        for variable in stage.consumes:
+            if variable in producers:
+                to_visit.append(producers[variable])
+            else:
+                roots.add(variable)
+    return roots
+
+
+def share_scope(stages, name, inputs, personal_variables):
+    """
+    Returns the sorted (variable, value) pairs that decide the output of a shareable stage, or None if
+    the stage is personalized.
+
+    A stage is shareable when its own prompt reads none of `personal_variables`; its scope is then every
+    root input it depends on minus the personal ones. Upstream personalized stages (the intro greets the
+    student by name) only flavour the wording of their output, so two students with the same scope get
+    the same generation of the stage.
+    """
+    if stages[name].personalized(personal_variables):
+        return None
+    return sorted(
+        (variable, inputs[variable])
+        for variable in root_variables(stages, name)
+        if variable not in personal_variables
+    )
+
+
+def input_fingerprint(stages, name, values, personal_variables):
+    """
+    Returns a fingerprint of what decides the output of stage `name` given the variables in `values`: the
+    stage's share_scope() if it is shareable, else the value of every variable it consumes. Two runs with
+    the same fingerprint can share one output, as they would share one cache entry.
+    """
+    scope = share_scope(stages, name, values, personal_variables)
+    if scope is None:
+        scope = ["consumed", [[variable, values[variable]] for variable in stages[name].consumes]]
+    return hashlib.sha256(json.dumps(scope).encode("utf-8")).hexdigest()
+
+
+def dirty_stages(stages, changed, personal_variables=()):
+    """
+    Returns the names of the stages whose output may change when the variables in `changed` change, with
+    the same rule as input_fingerprint(): a shareable stage is dirty when one of the non-personal root
+    inputs it depends on changed, a personalized stage when one of the variables it consumes changed,
+    including the outputs of dirty stages.
+
+    `stages` is a dict of stage name -> Stage.
+    """
+    changed = set(changed)
+    dirty = set()
+    propagated = True
+    while propagated:
+        propagated = False
+        for stage in stages.values():
+            if stage.name in dirty:
+                continue
+            if stage.personalized(personal_variables):
+                affected = changed.intersection(stage.consumes)
+            else:
+                affected = changed.intersection(root_variables(stages, stage.name) - set(personal_variables))
+            if affected:
+                dirty.add(stage.name)
+                changed.add(stage.produces)
+                propagated = True
+    return dirty
+
+
+def run_stage_graph(stages, run_stage, inputs, speculative=False, draft=None, max_workers=None):
+    """
+    Runs every stage once, launching each one as soon as its inputs are available.
+
+    Args:
+    - stages: iterable of Stage objects forming an acyclic graph over `inputs`.
+    - run_stage: callable(stage, stage_inputs) returning the stage's output. Called from worker threads.
+    - inputs: dict of the root variables (topic, background, ...).
+    - speculative: when True, a stage whose only missing inputs are `loose` ones starts right away and
+      `draft(variable, available)` supplies a stand-in value for each missing variable. The output of a
+      speculative run is final; the stage is not re-run once the real upstream value arrives.
+    - draft: callable(variable, available) -> str, required when `speculative` is True.
+    - max_workers: size of the thread pool; defaults to one thread per stage.
+
+    Yields:
+    - (stage name, output) tuples in completion order.
+
+    Raises:
+    - ValueError if some stage can never run because one of its inputs is never produced.
+    """
+    stages = list(stages)
+    if speculative and draft is None:
+        raise ValueError("speculative mode needs a draft callable")
+
+    available = dict(inputs)
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+
+    def launchable(stage):
+        needed = stage.required if speculative else stage.consumes
+        return all(variable in available for variable in needed)
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(stages), 1)) as executor:
+        try:
+            while pending or running:
+                for stage in [stage for stage in pending.values() if launchable(stage)]:
+                    stage_inputs = {
+                        variable: available[variable] if variable in available else draft(variable, available)
+                        for variable in stage.consumes
+                    }
+                    running[executor.submit(run_stage, stage, stage_inputs)] = stage
+                    del pending[stage.name]
+
+                if not running:
+                    raise ValueError(f"Stages {sorted(pending)} have inputs that are never produced")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    output = future.result()
+                    available[stage.produces] = output
+                    yield stage.name, output
+        finally:
+            for future in running:
+                future.cancel()
@@ -0,0 +1,80 @@
+"""Compaction of upstream outputs before they are inlined into a downstream prompt."""
+
+from context_budget import TRUNCATION_MARK, compact_key_concepts, fit_to_budget, parse_key_concepts, truncate_tables
+from token_count import count_tokens
+
+CODE = """Here is how to plot it:
+```python
+import numpy as np
+import matplotlib.pyplot as plt
+x = np.linspace(0, 10, 100)
+y = np.random.normal(0, 1, size=(100,))
+fig, ax = plt.subplots(1, 2, figsize=(8, 4))
+ax[0].plot(x, y, color="red")
+ax[1].hist(y, bins=20, alpha=0.5)
+plt.legend(["a", "b"], loc="upper left")
+plt.show()
+```"""
+
+
+def csv_block(rows, tag=""):
+    return "\n".join([f"```{tag}", "id,score,group", *(f"{row},{row * 2},a" for row in range(rows)), "```"])
+
+
+def test_parse_key_concepts_formats():
+    assert parse_key_concepts('#### {"2": "Beta", "1": "Alpha"} ####') == ["Alpha", "Beta"]
+    assert parse_key_concepts('{"1": {"name": "P-value", "description": "tail probability"}}') == [
+        "P-value: tail probability"
+    ]
+    assert parse_key_concepts('Concepts: "1": "Alpha", "2": "Beta" and more') == ["Alpha", "Beta"]
+    assert parse_key_concepts('{"1": [1, 2]}\n1. First\n2) Second') == ["First", "Second"]
+    assert parse_key_concepts("no concepts here") == []
+
+
+def test_compact_key_concepts_keeps_the_start_of_each_concept():
+    text = '{"1": "' + " ".join(f"w{i}" for i in range(30)) + '", "2": "Short one"}'
+    assert compact_key_concepts(text, words_per_concept=3) == "1. w0 w1 w2 ...\n2. Short one"
+    assert compact_key_concepts("plain prose") == "plain prose"
+
+
+def test_truncate_tables_cuts_markdown_tables_and_csv_fences():
+    table = "\n".join(["| a | b |", "|---|---|", *(f"| {row} | {row} |" for row in range(8))])
+    assert truncate_tables(table, max_rows=2).splitlines() == [
+        "| a | b |", "|---|---|", "| 0 | 0 |", "| 1 | 1 |", "| ... 6 more rows |"
+    ]
+    for tag in ("csv", ""):
+        lines = truncate_tables("Data:\n" + csv_block(8, tag) + "\nDone.", max_rows=2).splitlines()
+        assert lines == ["Data:", f"```{tag}", "id,score,group", "0,0,a", "1,2,a", "... 6 more rows", "```", "Done."]
+
+
+def test_truncate_tables_leaves_code_fences_whole():
+    assert truncate_tables(CODE, max_rows=2) == CODE
+    # an untagged block whose rows do not share the header's comma count is not CSV either
+    untagged = CODE.replace("```python", "```")
+    assert truncate_tables(untagged, max_rows=2) == untagged
+    # a CSV fence after a code fence is still cut
+    assert "... 6 more rows" in truncate_tables(CODE + "\n" + csv_block(8, "csv"), max_rows=2)
+
+
+def test_fit_to_budget_compacts_before_truncating():
+    inputs = {"table": csv_block(200), "note": "short note", "other": "x " * 500}
+    fitted = fit_to_budget(inputs, 60, {"table": [truncate_tables], "note": []})
+    assert fitted["other"] == inputs["other"]  # not listed in compactors
+    assert fitted["note"] == "short note"
+    assert "... 195 more rows" in fitted["table"] and not fitted["table"].endswith(TRUNCATION_MARK)
+
+    fitted = fit_to_budget(inputs, 20, {"table": [truncate_tables], "note": []})
+    assert count_tokens(fitted["table"]) + count_tokens(fitted["note"]) <= 20
+    assert fitted["table"].endswith(TRUNCATION_MARK)
+
+
+def test_fit_to_budget_summarizes_before_truncating():
+    calls = []
+
+    def summarize(text, max_tokens):
+        calls.append(max_tokens)
+        return "summary"
+
+    fitted = fit_to_budget({"analysis": "word " * 400}, 50, {"analysis": []}, summarize=summarize)
+    assert fitted == {"analysis": "summary"} and calls == [50]
+    assert fit_to_budget({"analysis": "small"}, 50, {"analysis": []}, summarize=summarize) == {"analysis": "small"}
@@ -0,0 +1,61 @@
+"""The application stage run as one call per key concept plus a merge. Runs on the fake model backend."""
+
+import asyncio
+
+import pytest
+
+from explain_the_concepts_new import (
+    DEFAULT_REQUEST,
+    FAN_OUT_MERGE_TITLE,
+    STAGES,
+    aprocess_chains,
+    fan_out_inputs,
+    merge_inputs,
+    process_chains,
+)
+
+FIRST_TOKEN_DELAY = 0.1
+KEY_CONCEPTS = '{"1": "Null hypothesis: no effect", "2": "Significance level: the threshold", "3": "Type I error"}'
+
+
+@pytest.fixture(autouse=True)
+def fake_backend(monkeypatch):
+    monkeypatch.setenv("AITUTOR_LLM_BACKEND", "fake")
+    monkeypatch.setenv("AITUTOR_CACHE", "0")
+    monkeypatch.setenv("AITUTOR_SINGLE_FLIGHT", "0")
+    monkeypatch.setenv("AITUTOR_HEDGE_BUDGET", "0")
+    monkeypatch.setenv("AITUTOR_FAKE_FIRST_TOKEN_DELAY", str(FIRST_TOKEN_DELAY))
+    monkeypatch.setenv("AITUTOR_FAKE_RESPONSE_TOKENS", "20")
+
+
+def test_every_concept_call_sees_the_whole_list():
+    inputs = {"keyconcepts_response": KEY_CONCEPTS, "background": "Biology", "topic": "p-values"}
+    per_concept = fan_out_inputs("application", inputs)
+    assert [concept_inputs["concept"] for concept_inputs in per_concept] == [
+        "Null hypothesis: no effect",
+        "Significance level: the threshold",
+        "Type I error",
+    ]
+    listed = "1. Null hypothesis: no effect\n2. Significance level: the threshold\n3. Type I error"
+    assert all(concept_inputs["keyconcepts_response"] == listed for concept_inputs in per_concept)
+
+    merged = merge_inputs(inputs, per_concept, ["first", "second", "third"])
+    assert merged["concept_sections"].splitlines()[:2] == ["Section 1: Null hypothesis: no effect", "first"]
+    assert merged["background"] == "Biology" and merged["topic"] == "p-values"
+
+
+def test_fanned_out_stage_ends_with_the_merge_and_times_the_model():
+    runs = {}
+    responses = dict(zip(STAGES, process_chains(DEFAULT_REQUEST, runs=runs)))
+    application = responses["application"]
+    assert application.startswith("**1. ") and "**5. " in application
+    assert application.index("**5. ") < application.index(f"**{FAN_OUT_MERGE_TITLE}**")
+    # the first delta is a heading; the time to first token is the model's
+    assert runs["application"]["ttft_s"] >= FIRST_TOKEN_DELAY
+
+
+def test_async_fan_out_matches_sync():
+    async def run():
+        return [response async for response in aprocess_chains(DEFAULT_REQUEST)]
+
+    assert asyncio.run(run())[STAGES.index("application")] == list(process_chains(DEFAULT_REQUEST))[2]
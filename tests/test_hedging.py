@@ -0,0 +1,196 @@
+"""Hedged model calls (see hedging.py) and how a stage run reports them."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import hedging
+import llm_cache
+from explain_the_concepts_new import DEFAULT_REQUEST, RoutedChain, astream_stage, stream_stage
+from metrics import registry
+from model_routes import Route
+
+ROUTE = Route("gpt-4", hedge_percentile=0.5, hedge_model="gpt-4-1106-preview")
+INPUTS = {"example_response": "a table", "analyze_response": "an analysis", "topic": "p-values"}
+
+
+class Model:
+    """Chain stand-in streaming `text` word by word after `delay` seconds."""
+
+    def __init__(self, text, delay=0.0):
+        self.text = text
+        self.delay = delay
+
+    def stream(self, inputs, config=None):
+        time.sleep(self.delay)
+        for word in self.text.split():
+            yield word + " "
+
+    async def astream(self, inputs, config=None):
+        await asyncio.sleep(self.delay)
+        for word in self.text.split():
+            yield word + " "
+
+
+class DictCache(dict):
+    """Response cache stand-in recording what is written to it."""
+
+    def put(self, key, value):
+        self[key] = value
+
+
+@pytest.fixture
+def hedged_visualize(monkeypatch):
+    """Chains where visualize's primary is slow to its first token and its hedge model is not."""
+    monkeypatch.setenv("AITUTOR_HEDGE_BUDGET", "1")
+    monkeypatch.setenv("AITUTOR_SINGLE_FLIGHT", "0")
+    monkeypatch.setattr(hedging, "_budget", hedging.HedgeBudget(1))
+    monkeypatch.setattr(llm_cache, "_default_cache", DictCache())
+    monkeypatch.setattr(registry, "histograms", {})
+    for _ in range(hedging.MIN_SAMPLES):
+        registry.observe("aitutor_model_ttft_seconds", {"stage": "visualize", "model": "gpt-4"}, 0.01)
+    models = {"gpt-4": Model("slow primary", delay=1.0), "gpt-4-1106-preview": Model("hedge answer")}
+    return {"visualize": RoutedChain(ROUTE, models)}
+
+
+def test_stage_won_by_the_hedge_model_is_labelled_with_it_and_not_cached(hedged_visualize):
+    runs = {}
+    text = "".join(stream_stage(hedged_visualize, "visualize", INPUTS, DEFAULT_REQUEST.inputs(), runs=runs))
+    assert text == "hedge answer "
+    assert runs["visualize"]["model"] == "gpt-4-1106-preview"
+    assert llm_cache.get_default_cache() == {}
+
+
+def test_async_stage_won_by_the_hedge_model_is_not_cached(hedged_visualize):
+    async def run():
+        deltas = astream_stage(hedged_visualize, "visualize", INPUTS, DEFAULT_REQUEST.inputs())
+        return "".join([chunk async for chunk in deltas])
+
+    assert asyncio.run(run()) == "hedge answer "
+    assert llm_cache.get_default_cache() == {}
+
+
+LABELS = {"stage": "visualize", "model": "gpt-4"}
+
+
+def call(chunks, delay=0.0, error=None, closed=None):
+    """Returns a start() callable streaming `chunks` after `delay` seconds, then raising `error` if given."""
+
+    def start():
+        try:
+            time.sleep(delay)
+            yield from chunks
+            if error is not None:
+                raise error
+        finally:
+            if closed is not None:
+                closed.set()
+
+    return start
+
+
+def acall(chunks, delay=0.0, error=None, closed=None):
+    """Async counterpart of call(); `closed` is a list appended to once the call ends."""
+
+    async def start():
+        try:
+            await asyncio.sleep(delay)
+            for chunk in chunks:
+                yield chunk
+            if error is not None:
+                raise error
+        finally:
+            if closed is not None:
+                closed.append(True)
+
+    return start
+
+
+def counter(name):
+    return registry.counters.get((name, tuple(sorted(LABELS.items()))), 0)
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(registry, "counters", {})
+
+
+def test_budget_caps_hedges_at_its_ratio_and_burst():
+    budget = hedging.HedgeBudget(0.25, burst=2)
+    for _ in range(3):
+        budget.record_call()
+    assert not budget.try_spend()
+    budget.record_call()
+    assert budget.try_spend() and not budget.try_spend()
+    for _ in range(100):
+        budget.record_call()
+    assert [budget.try_spend() for _ in range(3)] == [True, True, False]
+
+
+def test_first_delta_wins_and_the_loser_is_abandoned():
+    closed, winners = threading.Event(), []
+    primary = call(["slow"], delay=0.5, closed=closed)
+    hedge, budget = call(["fast", "hedge"]), hedging.HedgeBudget(1)
+    deltas = hedging.stream_hedged(primary, hedge, 0.05, budget, LABELS, winners.append)
+    assert list(deltas) == ["fast", "hedge"]
+    assert winners == ["hedge"]
+    assert counter("aitutor_stage_hedges_total") == counter("aitutor_stage_hedge_wins_total") == 1
+    assert closed.wait(2)  # closed at its first delta, which is never yielded
+
+
+def test_primary_that_answers_in_time_is_not_hedged():
+    winners = []
+    budget = hedging.HedgeBudget(1)
+    deltas = hedging.stream_hedged(call(["a", "b"]), call(["hedge"]), 0.5, budget, LABELS, winners.append)
+    assert list(deltas) == ["a", "b"] and winners == ["primary"]
+    assert counter("aitutor_stage_hedges_total") == 0
+
+
+def test_hedge_takes_over_from_a_primary_that_fails():
+    primary = call([], delay=0.1, error=ValueError("primary down"))
+    deltas = hedging.stream_hedged(primary, call(["hedge"], delay=0.2), 0.05, hedging.HedgeBudget(1), LABELS)
+    assert list(deltas) == ["hedge"]
+
+
+def test_errors_on_both_sides_raise():
+    primary = call([], delay=0.2, error=ValueError("primary down"))
+    hedge = call([], error=RuntimeError("hedge down"))
+    with pytest.raises(RuntimeError, match="hedge down"):
+        list(hedging.stream_hedged(primary, hedge, 0.05, hedging.HedgeBudget(1), LABELS))
+
+
+def test_no_hedge_without_budget():
+    budget, hedges = hedging.HedgeBudget(0.5), []
+
+    def hedge():
+        hedges.append(True)
+        return iter(["hedge"])
+
+    results = [list(hedging.stream_hedged(call(["slow"], delay=0.1), hedge, 0.02, budget, LABELS)) for _ in range(2)]
+    assert results == [["slow"], ["hedge"]]
+    assert len(hedges) == counter("aitutor_stage_hedges_total") == 1
+
+
+def test_async_first_delta_wins_and_the_loser_is_closed():
+    async def run():
+        closed, winners = [], []
+        primary = acall(["slow"], delay=0.5, closed=closed)
+        hedge, budget = acall(["fast", "hedge"]), hedging.HedgeBudget(1)
+        deltas = hedging.astream_hedged(primary, hedge, 0.05, budget, LABELS, winners.append)
+        assert [chunk async for chunk in deltas] == ["fast", "hedge"]
+        assert winners == ["hedge"] and closed
+
+    asyncio.run(run())
+    assert counter("aitutor_stage_hedge_wins_total") == 1
+
+
+def test_async_errors_on_both_sides_raise():
+    async def run():
+        primary = acall([], delay=0.2, error=ValueError("primary down"))
+        hedge = acall([], error=RuntimeError("hedge down"))
+        return [chunk async for chunk in hedging.astream_hedged(primary, hedge, 0.05, hedging.HedgeBudget(1), LABELS)]
+
+    with pytest.raises(RuntimeError, match="hedge down"):
+        asyncio.run(run())
@@ -0,0 +1,80 @@
+"""
+Which stages a session reuses from the previous one when some of its inputs change (see
+explain_the_concepts_new.reusable_section). Runs on the fake model backend.
+"""
+
+import time
+from dataclasses import replace
+
+import pytest
+
+from explain_the_concepts_new import DEFAULT_REQUEST, PERSONAL_VARIABLES, STAGE_GRAPH, STAGES, process_chains
+from metrics import registry
+from session_jobs import SessionJobs
+from session_store import MemorySessionStore, StoredSession
+from stage_graph import dirty_stages
+
+CHANGES = {
+    "topic": "t-tests",
+    "background": "Biology",
+    "course": "Biology",
+    "course_expertise": "Advanced",
+    "name": "Ana",
+}
+
+
+@pytest.fixture(autouse=True)
+def fake_backend(monkeypatch):
+    monkeypatch.setenv("AITUTOR_LLM_BACKEND", "fake")
+    monkeypatch.setenv("AITUTOR_CACHE", "0")
+    monkeypatch.setenv("AITUTOR_SINGLE_FLIGHT", "0")
+    monkeypatch.setenv("AITUTOR_HEDGE_BUDGET", "0")
+
+
+def previous_session():
+    return StoredSession(None, DEFAULT_REQUEST, 0.0, {stage: f"previous {stage}" for stage in STAGES})
+
+
+def reused_stages(request):
+    responses = process_chains(request, previous=previous_session())
+    return [stage for stage, response in zip(STAGES, responses) if response == f"previous {stage}"]
+
+
+@pytest.mark.parametrize("variable", ["topic", "background", "course", "course_expertise"])
+def test_non_personal_input_change_regenerates_every_stage(variable):
+    assert dirty_stages(STAGE_GRAPH, [variable], PERSONAL_VARIABLES) == set(STAGES)
+    assert reused_stages(replace(DEFAULT_REQUEST, **{variable: CHANGES[variable]})) == []
+
+
+def test_name_change_regenerates_only_the_intro():
+    assert dirty_stages(STAGE_GRAPH, ["name"], PERSONAL_VARIABLES) == {"intro"}
+    assert reused_stages(replace(DEFAULT_REQUEST, name=CHANGES["name"])) == STAGES[1:]
+
+
+def test_unchanged_inputs_reuse_every_stage():
+    assert reused_stages(DEFAULT_REQUEST) == STAGES
+
+
+def stage_runs():
+    return sum(value for (name, _), value in registry.counters.items() if name == "aitutor_stage_runs_total")
+
+
+def wait(job):
+    while not job.done:
+        time.sleep(0.01)
+    assert job.error is None
+    return job
+
+
+def test_session_with_new_course_and_expertise_is_regenerated_and_stored():
+    store = MemorySessionStore()
+    jobs = SessionJobs(max_workers=1, store=store)
+    first = wait(jobs.submit("student", DEFAULT_REQUEST))
+
+    request = replace(DEFAULT_REQUEST, course="Biology", course_expertise="Advanced")
+    runs_before = stage_runs()
+    second = wait(jobs.submit("student", request))
+
+    assert second.regenerating == STAGES
+    assert stage_runs() - runs_before == len(STAGES)
+    assert store.find(request).session_id == second.session_id != first.session_id
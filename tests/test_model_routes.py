@@ -0,0 +1,105 @@
+"""Falling back from a route's primary model that fails or misses its first-token budget (see model_routes.py)."""
+
+import asyncio
+import time
+
+from model_routes import AttemptClock, Route, astream_with_fallback, stream_with_fallback
+
+ROUTE = Route("primary", fallback="fallback", timeout=0.1)
+
+
+def models(primary, fallback=("from fallback",)):
+    """Returns start(model): `primary` for the primary, a call streaming `fallback` for the fallback."""
+
+    def start(model):
+        return primary() if model == "primary" else iter(fallback)
+
+    return start
+
+
+def slow(delay, chunks=("from primary",), error=None, clock=None, queued=0.0):
+    """A primary waiting `queued` seconds for its slot (starting `clock` after it), then `delay` to answer."""
+
+    def primary():
+        time.sleep(queued)
+        if clock is not None:
+            clock.start()
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        yield from chunks
+
+    return primary
+
+
+def run(route, start, clock=None):
+    reasons = []
+    return list(stream_with_fallback(route, start, reasons.append, clock)), reasons
+
+
+def test_primary_within_its_budget_is_streamed():
+    assert run(ROUTE, models(slow(0.01, ("a", "b")))) == (["a", "b"], [])
+
+
+def test_first_token_timeout_switches_to_the_fallback():
+    assert run(ROUTE, models(slow(0.5))) == (["from fallback"], ["timeout"])
+
+
+def test_primary_error_switches_to_the_fallback():
+    assert run(ROUTE, models(slow(0.01, error=ValueError("down")))) == (["from fallback"], ["error"])
+
+
+def test_route_without_fallback_waits_for_the_primary():
+    assert run(Route("primary", timeout=0.1), models(slow(0.3))) == (["from primary"], [])
+
+
+def test_queue_time_does_not_count_against_the_budget_with_an_attempt_clock():
+    # without a clock, waiting for the rate-limit slot uses up the budget
+    assert run(ROUTE, models(slow(0.01, queued=0.3)))[1] == ["timeout"]
+    clock = AttemptClock()
+    assert run(ROUTE, models(slow(0.01, clock=clock, queued=0.3)), clock) == (["from primary"], [])
+    # once the attempt is in flight, the budget runs as usual
+    clock = AttemptClock()
+    assert run(ROUTE, models(slow(0.5, clock=clock, queued=0.3)), clock) == (["from fallback"], ["timeout"])
+
+
+def aslow(delay, chunks=("from primary",), error=None, clock=None, queued=0.0):
+    """Async counterpart of slow()."""
+
+    async def primary():
+        await asyncio.sleep(queued)
+        if clock is not None:
+            clock.start()
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        for chunk in chunks:
+            yield chunk
+
+    return primary
+
+
+def arun(route, primary, clock=None):
+    async def fallback():
+        yield "from fallback"
+
+    def start(model):
+        return primary() if model == "primary" else fallback()
+
+    async def collect():
+        reasons = []
+        return [chunk async for chunk in astream_with_fallback(route, start, reasons.append, clock)], reasons
+
+    return asyncio.run(collect())
+
+
+def test_async_fallback_on_timeout_and_error():
+    assert arun(ROUTE, aslow(0.01, ("a", "b"))) == (["a", "b"], [])
+    assert arun(ROUTE, aslow(0.5)) == (["from fallback"], ["timeout"])
+    assert arun(ROUTE, aslow(0.01, error=ValueError("down"))) == (["from fallback"], ["error"])
+
+
+def test_async_queue_time_does_not_count_against_the_budget_with_an_attempt_clock():
+    assert arun(ROUTE, aslow(0.01, queued=0.3))[1] == ["timeout"]
+    clock = AttemptClock()
+    assert arun(ROUTE, aslow(0.01, clock=clock, queued=0.3), clock) == (["from primary"], [])
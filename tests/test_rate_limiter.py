@@ -0,0 +1,56 @@
+"""RateLimiter queueing shared by thread and event loop callers."""
+
+import asyncio
+import threading
+
+from rate_limiter import RateLimiter
+
+
+def test_aacquire_waits_on_the_loop_in_arrival_order_with_sync_callers():
+    limiter = RateLimiter(requests_per_minute=600)  # one request every 0.1 s once the bucket is empty
+    limiter.requests.level = 0
+    order = []
+
+    async def main():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        async def acquire(name):
+            await limiter.aacquire()
+            order.append(name)
+
+        ticker = asyncio.ensure_future(tick())
+        first = asyncio.ensure_future(acquire("async 1"))
+        await asyncio.sleep(0.01)
+        thread = threading.Thread(target=lambda: (limiter.acquire(), order.append("sync")))
+        thread.start()
+        await asyncio.sleep(0.01)
+        await asyncio.gather(first, acquire("async 2"))
+        await asyncio.to_thread(thread.join)
+        ticker.cancel()
+        return ticks
+
+    ticks = asyncio.run(main())
+    assert order == ["async 1", "sync", "async 2"]
+    assert ticks >= 10  # the loop kept running while the callers waited
+    assert limiter.waiting() == 0
+
+
+def test_cancelled_aacquire_leaves_the_queue():
+    limiter = RateLimiter(requests_per_minute=60)
+    limiter.requests.level = 0
+
+    async def main():
+        waiter = asyncio.ensure_future(limiter.aacquire())
+        await asyncio.sleep(0.02)
+        assert limiter.waiting() == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(main())
+    assert limiter.waiting() == 0
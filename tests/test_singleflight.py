@@ -0,0 +1,175 @@
+"""Coalescing of identical in-flight calls, on threads and on an event loop (see singleflight.py)."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+def not_called():
+    raise AssertionError("a caller attached to a call in flight must not start another one")
+
+
+class Source:
+    """Deltas "a", then the rest once `release` is set; raises `error` at the end if given."""
+
+    def __init__(self, rest=("b", "c"), error=None):
+        self.rest = rest
+        self.error = error
+        self.release = threading.Event()
+
+    def __call__(self):
+        yield "a"
+        self.release.wait(5)
+        yield from self.rest
+        if self.error is not None:
+            raise self.error
+
+
+def endless(closed):
+    try:
+        while True:
+            yield "delta"
+            time.sleep(0.01)
+    finally:
+        closed.set()
+
+
+def test_late_reader_receives_every_delta_from_the_start():
+    flights, source = SingleFlight(), Source()
+    first, joined = flights.stream("key", source)
+    assert not joined and next(first) == "a"
+    late, joined = flights.stream("key", not_called)
+    assert joined
+    source.release.set()
+    assert list(late) == ["a", "b", "c"]
+    assert list(first) == ["b", "c"]
+
+
+def test_error_reaches_every_reader():
+    flights, source = SingleFlight(), Source(error=ValueError("provider down"))
+    readers = [flights.stream("key", source)[0], flights.stream("key", not_called)[0]]
+    source.release.set()
+    for deltas in readers:
+        received = []
+        with pytest.raises(ValueError, match="provider down"):
+            for chunk in deltas:
+                received.append(chunk)
+        assert received == ["a", "b", "c"]
+
+
+def test_call_stops_once_every_reader_closed():
+    flights, closed = SingleFlight(), threading.Event()
+    readers = [flights.stream("key", lambda: endless(closed))[0], flights.stream("key", not_called)[0]]
+    for deltas in readers:
+        assert next(deltas) == "delta"
+    readers[0].close()
+    assert not closed.wait(0.1)  # the other reader still wants it
+    readers[1].close()
+    assert closed.wait(2)
+    assert flights.in_flight() == 0
+
+
+def test_key_is_freed_for_the_next_call():
+    flights = SingleFlight()
+    assert list(flights.stream("key", lambda: iter(["first"]))[0]) == ["first"]
+    assert flights.in_flight() == 0
+    deltas, joined = flights.stream("key", lambda: iter(["second"]))
+    assert not joined and list(deltas) == ["second"]
+
+
+class AsyncSource:
+    """Async counterpart of Source; create it inside the event loop."""
+
+    def __init__(self, rest=("b", "c"), error=None):
+        self.rest = rest
+        self.error = error
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        yield "a"
+        await self.release.wait()
+        for chunk in self.rest:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+async def aiterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(deltas):
+    return [chunk async for chunk in deltas]
+
+
+def test_async_late_reader_receives_every_delta_from_the_start():
+    async def run():
+        flights, source = AsyncSingleFlight(), AsyncSource()
+        first, joined = flights.stream("key", source)
+        assert not joined and await first.__anext__() == "a"
+        late, joined = flights.stream("key", not_called)
+        assert joined
+        source.release.set()
+        assert await collect(late) == ["a", "b", "c"]
+        assert await collect(first) == ["b", "c"]
+
+    asyncio.run(run())
+
+
+def test_async_error_reaches_every_reader():
+    async def run():
+        flights, source = AsyncSingleFlight(), AsyncSource(error=ValueError("provider down"))
+        readers = [flights.stream("key", source)[0], flights.stream("key", not_called)[0]]
+        source.release.set()
+        for deltas in readers:
+            received = []
+            with pytest.raises(ValueError, match="provider down"):
+                async for chunk in deltas:
+                    received.append(chunk)
+            assert received == ["a", "b", "c"]
+
+    asyncio.run(run())
+
+
+def test_async_call_stops_once_every_reader_closed():
+    async def run():
+        closed = []
+
+        async def endless_async():
+            try:
+                while True:
+                    yield "delta"
+                    await asyncio.sleep(0.01)
+            finally:
+                closed.append(True)
+
+        flights = AsyncSingleFlight()
+        readers = [flights.stream("key", endless_async)[0], flights.stream("key", not_called)[0]]
+        for deltas in readers:
+            assert await deltas.__anext__() == "delta"
+        await readers[0].aclose()
+        await asyncio.sleep(0.1)
+        assert not closed  # the other reader still wants it
+        await readers[1].aclose()
+        for _ in range(100):
+            if closed:
+                break
+            await asyncio.sleep(0.02)
+        assert closed
+
+    asyncio.run(run())
+
+
+def test_async_key_is_freed_for_the_next_call():
+    async def run():
+        flights = AsyncSingleFlight()
+        assert await collect(flights.stream("key", lambda: aiterate(["first"]))[0]) == ["first"]
+        deltas, joined = flights.stream("key", lambda: aiterate(["second"]))
+        assert not joined and await collect(deltas) == ["second"]
+
+    asyncio.run(run())
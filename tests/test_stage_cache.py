@@ -0,0 +1,33 @@
+"""Which stage runs write to the response cache, and under which keys. Runs on the fake model backend."""
+
+import pytest
+
+import llm_cache
+from batch_generate import run_chunk
+from explain_the_concepts_new import DEFAULT_REQUEST, STAGES, build_chains, process_chains, process_stage_graph
+
+
+@pytest.fixture(autouse=True)
+def memory_cache(monkeypatch):
+    monkeypatch.setenv("AITUTOR_LLM_BACKEND", "fake")
+    monkeypatch.setenv("AITUTOR_SINGLE_FLIGHT", "0")
+    monkeypatch.setenv("AITUTOR_HEDGE_BUDGET", "0")
+    monkeypatch.setattr(llm_cache, "_default_cache", llm_cache.TieredCache(path=None))
+
+
+def cached_stages(request):
+    runs = {}
+    list(process_chains(request, runs=runs))
+    return [stage for stage in STAGES if runs[stage]["cached"]]
+
+
+def test_speculative_runs_are_not_cached():
+    list(process_stage_graph(DEFAULT_REQUEST, speculative=True))
+    assert cached_stages(DEFAULT_REQUEST) == []
+    assert cached_stages(DEFAULT_REQUEST) == STAGES
+
+
+def test_batch_application_is_not_served_to_fanned_out_sessions():
+    [record] = run_chunk(build_chains(), [DEFAULT_REQUEST], max_concurrency=2)
+    assert "**1." not in record["responses"]["application"]
+    assert "application" not in cached_stages(DEFAULT_REQUEST)
@@ -0,0 +1,28 @@
+"""
+Token counting for prompts and responses.
+
+Uses tiktoken's encoding for the model when tiktoken is installed, and falls back to the usual estimate of
+four characters per token otherwise.
+"""
+
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model="gpt-4"):
+    """Returns the number of tokens `text` takes for `model`."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,189 @@
+"""
+Opt-in, sampled tracing of tutoring sessions.
+
+Tracing is off unless AITUTOR_TRACE_SAMPLE_RATE is set above 0. A sampled session records one span per
+stage (start time, duration, cache hit, output size, error). Spans go to a bounded in-memory queue and a
+background thread hands them to the exporter, so the stage never waits on trace I/O. When the queue is
+full, spans are dropped and counted instead of slowing the session down.
+
+Exporters, chosen with AITUTOR_TRACE_EXPORTER:
+- "jsonl" (default): appends spans to AITUTOR_TRACE_PATH (traces.jsonl).
+- "memory": keeps spans in MemoryExporter.spans, for tests and in-process collectors.
+- "langsmith": additionally attaches langchain's LangChainTracer to the sampled sessions' chain calls.
+  It uses the usual LANGCHAIN_API_KEY / LANGCHAIN_ENDPOINT / LANGCHAIN_PROJECT settings.
+"""
+
+import json
+import os
+import queue
+import random
+import threading
+import uuid
+from contextlib import contextmanager
+from time import perf_counter, sleep, time
+
+
+class JsonlExporter:
+    """Appends each span as one JSON line to `path`."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span) + "\n")
+
+
+class MemoryExporter:
+    """Collects spans in memory."""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class SessionTrace:
+    """Spans of one sampled session."""
+
+    def __init__(self, tracer, session):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex
+        self.session = session
+
+    @contextmanager
+    def span(self, stage):
+        """Times the body as one stage span. The body may add attributes to the yielded dict."""
+        attributes = {}
+        started_at = time()
+        start = perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as exception:
+            error = repr(exception)
+            raise
+        finally:
+            self.tracer.submit(
+                {
+                    "trace_id": self.trace_id,
+                    "session": self.session,
+                    "stage": stage,
+                    "started_at": started_at,
+                    "duration_s": perf_counter() - start,
+                    "error": error,
+                    **attributes,
+                }
+            )
+
+    def config(self):
+        """Runnable config for the session's chain calls."""
+        if not self.tracer.langsmith:
+            return {}
+        from langchain_core.tracers import LangChainTracer
+
+        return {"callbacks": [LangChainTracer()], "metadata": {"trace_id": self.trace_id}}
+
+
+class UnsampledTrace:
+    """Stand-in for sessions that are not sampled; records nothing."""
+
+    @contextmanager
+    def span(self, stage):
+        yield {}
+
+    def config(self):
+        return {}
+
+
+UNSAMPLED = UnsampledTrace()
+
+
+class Tracer:
+    """
+    Samples sessions and exports their spans from a background thread.
+
+    - sample_rate: fraction of sessions traced, 0 to disable tracing.
+    - exporter: object with an `export(spans)` method, called from the background thread.
+    - max_queue: spans buffered before new ones are dropped.
+    - langsmith: also trace sampled sessions' chain calls with LangChainTracer.
+    """
+
+    def __init__(self, sample_rate, exporter, max_queue=1000, langsmith=False):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.langsmith = langsmith
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def start_session(self, session):
+        """Returns a SessionTrace if this session is sampled, else UNSAMPLED."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return UNSAMPLED
+        return SessionTrace(self, session)
+
+    def submit(self, span):
+        """Queues a span for export without blocking."""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._drain, daemon=True)
+                self._worker.start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        """Waits until every queued span has been exported, or `timeout` seconds have passed."""
+        deadline = perf_counter() + timeout
+        while self._queue.unfinished_tasks and perf_counter() < deadline:
+            sleep(0.01)
+
+    def _drain(self):
+        while True:
+            spans = [self._queue.get()]
+            while True:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(spans)
+            except Exception as error:
+                print(f"Trace export failed: {error!r}")
+            finally:
+                for _ in spans:
+                    self._queue.task_done()
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """Returns the process-wide Tracer, configured from the environment on first use."""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            exporter_name = os.getenv("AITUTOR_TRACE_EXPORTER", "jsonl")
+            if exporter_name == "memory":
+                exporter = MemoryExporter()
+            else:
+                exporter = JsonlExporter(os.getenv("AITUTOR_TRACE_PATH", "traces.jsonl"))
+            _tracer = Tracer(
+                sample_rate=float(os.getenv("AITUTOR_TRACE_SAMPLE_RATE", "0")),
+                exporter=exporter,
+                max_queue=int(os.getenv("AITUTOR_TRACE_QUEUE_SIZE", "1000")),
+                langsmith=exporter_name == "langsmith",
+            )
+        return _tracer
+
+
+def start_session_trace(request):
+    """Starts the trace of a tutoring session; the student's name is left out of the exported spans."""
+    session = {key: value for key, value in request.inputs().items() if key != "name"}
+    return get_tracer().start_session(session)